@@ -10,13 +10,43 @@ from google.genai import types
 from google.adk.tools.mcp_tool import McpToolset 
 # from google.adk.tools.mcp_tool.mcp_session_manager import StdioConnectionParams 
 # from mcp import StdioServerParameters 
-from google.adk.tools.mcp_tool.mcp_session_manager import SseConnectionParams
+from google.adk.tools.mcp_tool.mcp_session_manager import SseConnectionParams, StreamableHTTPConnectionParams
+from opentelemetry import propagate
 
 # PASTE YOUR URL HERE and add /sse at the end
 #MCP_SERVER_URL = "http://localhost:8080/sse"
 MCP_SERVER_URL = "https://j-mcp-github-server8thjan-151498078937.us-central1.run.app/sse"
-connection_params = SseConnectionParams(url=MCP_SERVER_URL)
-github_toolset = McpToolset(connection_params=connection_params)
+
+# "http" talks to a server started with MCP_TRANSPORT=http (stateless streamable
+# HTTP at /mcp): no long-lived connection, so requests can go to any instance.
+MCP_SERVER_TRANSPORT = os.getenv("MCP_SERVER_TRANSPORT", "sse")
+if MCP_SERVER_TRANSPORT == "http":
+    connection_params = StreamableHTTPConnectionParams(url=MCP_SERVER_URL.rsplit("/sse", 1)[0] + "/mcp")
+else:
+    connection_params = SseConnectionParams(url=MCP_SERVER_URL)
+
+# Set MCP_TRACE_PROPAGATION=1 to send the current span's traceparent with every
+# tool call, so the MCP server's spans join the agent's trace. The headers change
+# per call, so ADK opens a new MCP session for each one. Use it for profiling runs only.
+MCP_TRACE_PROPAGATION = os.getenv("MCP_TRACE_PROPAGATION", "0") == "1"
+
+def _mcp_headers(readonly_context=None) -> dict:
+    """
+    Per-session headers for the MCP server. A 'github_token' in session state is
+    sent as X-GitHub-Token, so the server acts as that user with its own budget.
+    """
+    headers = {}
+    token = readonly_context.state.get("github_token") if readonly_context is not None else None
+    if token:
+        headers["X-GitHub-Token"] = token
+    if MCP_TRACE_PROPAGATION:
+        propagate.inject(headers)
+    return headers
+
+github_toolset = McpToolset(
+    connection_params=connection_params,
+    header_provider=_mcp_headers
+)
 
 # --- 2. Define the Root Agent ---
 root_agent = Agent(
@@ -31,10 +61,15 @@ You are the **GitHub Documentation Architect**. Your goal is to provide deep rep
 ### PHASE 1: INITIALIZATION & WELCOME
 - Introduce yourself as an expert in repository architecture, automated code summarization, and PR orchestration.
 - Request the **GitHub Owner** and **Repository Name** to begin.
+- **Organization audit:** If the user asks about a whole organization instead of one repository, call
+  `audit_org_readmes` with the org (and any filters they give). While `complete` is false, call it again with the
+  returned `checkpoint_id` and no filters. Present the per-repo `report`, let the user pick a repository, then continue with Phase 2.
 
 ### PHASE 2: CONTEXT & SCOPE SELECTION (Interactive)
 1. **Branch Identification:** Call `list_branches`. Present the list and ask: "Which branch should I use as the base for this analysis?" 
    - *Wait for user input.*
+   - Once the user picks a branch, call `pin_ref` with that branch as `ref` and `refresh=True`, so this run reads
+     the branch's latest commit rather than one pinned by an earlier run.
 2. **Directory Discovery:** Call `list_repo_directories` for the root path (path="").
 3. **Targeting Selection:**
    - Present the list of directories (ensure "Root (.)" is explicitly shown).
@@ -45,8 +80,15 @@ You are the **GitHub Documentation Architect**. Your goal is to provide deep rep
 ### PHASE 3: ANALYSIS & SUMMARIZATION
 Using the selected branch as the `ref` for all tool calls:
 1. **Inventory:** Execute `find_readme_targets`. 
+   - **Large repositories:** Call `start_scan` with the same arguments instead, then `get_scan_status` with
+     `wait_seconds=120` until its status is `done`, then `get_scan_result` for the targets.
+   - **Reruns:** If this branch was documented before and the user gives the last documented commit SHA, call
+     `find_changed_directories` with it as `base_sha` and only process targets listed in `changed_directories`.
 2. **Technical Audit:** For every identified target path (including the Root `.`):
-   - **MANDATORY:** Call `read_file_content` for the files in that specific location.
+   - **MANDATORY:** Call `summarize_directory` **once per target**. It returns each file's imports, classes,
+     function signatures and docstrings, which is usually all the summaries below need.
+     Only call `read_files_batch` (or `read_file_content` for a file in `truncated_files`) when an outline is not
+     enough to explain what a file does.
    - **Technical Summaries:** Generate a detailed summary for each file including:
      - **Functional Purpose:** What the file does.
      - **Libraries/Dependencies:** List key imports/libraries used.
@@ -58,9 +100,7 @@ Using the selected branch as the `ref` for all tool calls:
 ### PHASE 4: BATCHED WORKFLOW EXECUTION (Unified PR)
 Upon confirmation, perform these steps in this EXACT sequence to ensure only ONE Pull Request is created:
 
-1. **SINGLE BRANCH CREATION:** Call `create_branch` **ONCE** to create a new feature branch (e.g., `feature/docs-update-[timestamp]`). 
-   - **CRITICAL:** Use the user's selected branch from Phase 2 as the `source_branch`.
-2. **FILE GENERATION & COMMIT LOOP:** For EACH identified target (Root and/or Subdirectories):
+1. **FILE GENERATION:** For EACH identified target (Root and/or Subdirectories):
    - Call `analyze_and_suggest_readme` (using the selected branch as `ref`).
    - **Mandatory README Structure:**
      - **1. Project Identification and Overview:** Title, Description, and Status/Badges.
@@ -68,14 +108,18 @@ Upon confirmation, perform these steps in this EXACT sequence to ensure only ONE
      - **3. Documentation and Resources:** Features list and Documentation links.
      - **4. Contributing and Community:** Guidelines, Code of Conduct, and Reporting Issues.
      - **5. Legal and Contact:** License Info, Contact/Support, and Acknowledgements.
-   - **COMMIT:** Call `commit_file_to_github` to write the README to the **NEW feature branch** created in Step 1.
-3. **SINGLE PULL REQUEST:** After ALL files are committed, call `create_pull_request` **ONCE**.
-   - **Head:** The new feature branch.
-   - **Base:** The user's selected branch from Phase 2.
-   - Present the final PR link clearly.
+2. **PUBLISH:** After ALL READMEs are generated, call `publish_docs` **ONCE** with:
+   - **base:** The user's selected branch from Phase 2.
+   - **files:** Every `{path, content}` pair.
+   - **branch:** A new feature branch name (e.g., `feature/docs-update-[timestamp]`).
+   - **title / body:** The Pull Request title and description.
+   It creates the branch, writes all READMEs as a single commit and opens the Pull Request in one call.
+   If it returns an ERROR, report it to the user, including its rollback note. Do not retry step by step with
+   `create_branch`, `commit_files_to_github` or `create_pull_request`.
+3. Present the final PR link clearly.
 
 ### OPERATIONAL CONSTRAINTS:
-- **Unified PR:** Never call `create_branch` or `create_pull_request` more than once per session. Batch all commits onto one branch.
+- **Unified PR:** Never call `publish_docs` more than once per session. Batch all READMEs into that one call.
 - **Zero-Assumption Policy:** Always verify branch/targets. Never assume 'main'.
 - **Structure Integrity:** Ensure all 5 mandatory sections are present in every README.
 - **Interactive Gates:** Stop and wait for user input at every 'Wait for user' marker.
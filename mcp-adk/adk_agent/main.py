@@ -5,6 +5,20 @@ from google.adk.cli.fast_api import get_fast_api_app
 # Cloud Run provides the PORT environment variable
 port = int(os.environ.get("PORT", 8080))
 
+# Optional: write agent spans (LLM calls, tool calls) to a local file, one JSON span
+# per line, so a run can be profiled offline next to the MCP server's trace file.
+if os.environ.get("OTEL_TRACES_FILE"):
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "adk-agent"}))
+    exporter = ConsoleSpanExporter(out=open(os.environ["OTEL_TRACES_FILE"], "a", encoding="utf-8"),
+                                   formatter=lambda span: span.to_json(indent=None) + "\n")
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
 # Fixed: Added web=True (required) and plural agents_dir
 app = get_fast_api_app(
     agents_dir=".", 
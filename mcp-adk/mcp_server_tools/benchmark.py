@@ -0,0 +1,352 @@
+# --- File: benchmark.py (Local benchmarks for mcp_server_v2.py) ---
+# Runs the server's GitHub helpers against a local HTTP stand-in so latency
+# can be measured without touching api.github.com or spending rate limit.
+#
+#   python benchmark.py pool --calls 200
+#   python benchmark.py fanout --dirs 200 --delay 0.02
+#   python benchmark.py throttle --calls 40
+#   python benchmark.py graphql --dirs 200 --delay 0.02
+#   python benchmark.py coldstart --runs 5
+#
+# coldstart appends to a history file outside the repo (see --history) so runs
+# on the same machine can be compared.
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import statistics
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+DEFAULT_HISTORY = os.path.join(tempfile.gettempdir(), "mcp-benchmarks", "coldstart_history.jsonl")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Minimal GitHub API imitation. Routes are looked up on the server object."""
+    protocol_version = "HTTP/1.1"  # keep-alive, like api.github.com
+    disable_nagle_algorithm = True
+
+    def _dispatch(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.server.request_count += 1
+        for matcher, handler in self.server.routes:
+            if matcher(self.command, self.path):
+                status, headers, payload = handler(self, body)
+                break
+        else:
+            status, headers, payload = 404, {}, {"message": "Not Found"}
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", headers.pop("Content-Type", "application/json"))
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(routes, delay: float = 0.0):
+    """Starts the stand-in on a free port and points the server module at it."""
+    def delayed(handler):
+        def wrapper(request, body):
+            if delay:
+                time.sleep(delay)
+            return handler(request, body)
+        return wrapper
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.routes = [(matcher, delayed(handler)) for matcher, handler in routes]
+    server.request_count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["GITHUB_API_URL"] = f"http://127.0.0.1:{server.server_port}"
+    os.environ.setdefault("GITHUB_TOKEN", "benchmark-token")
+    # The stand-ins do not serve /commits/{ref}; pinning would add a failed lookup per scan
+    os.environ.setdefault("REF_PINNING", "0")
+    return server
+
+
+def _contents_route(method, path):
+    return method == "GET" and "/contents/" in path
+
+
+def _contents_listing(request, body):
+    return 200, {}, [{"name": f"file_{i}.py", "type": "file", "size": 100} for i in range(20)]
+
+
+def _summarize(label, samples):
+    samples_ms = sorted(s * 1000 for s in samples)
+    p95 = samples_ms[int(len(samples_ms) * 0.95) - 1]
+    print(f"{label:<28} mean={statistics.mean(samples_ms):7.3f}ms "
+          f"p50={statistics.median(samples_ms):7.3f}ms p95={p95:7.3f}ms")
+    return statistics.mean(samples_ms)
+
+
+def bench_pool(args):
+    """Per-call latency of one-shot requests.get versus the pooled session."""
+    server = start_stand_in([(_contents_route, _contents_listing)], delay=args.delay)
+    import mcp_server_v2 as srv
+
+    url = f"{srv.GITHUB_API_URL}/repos/octo/demo/contents/"
+    headers = srv._get_auth_headers()
+
+    unpooled = []
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        requests.get(url, headers=headers, timeout=srv.HTTP_TIMEOUT).json()
+        unpooled.append(time.perf_counter() - start)
+
+    pooled = []
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        srv._http_request("GET", url, headers=headers).json()
+        pooled.append(time.perf_counter() - start)
+
+    before = _summarize("requests.get (new conn)", unpooled)
+    after = _summarize("pooled session", pooled)
+    print(f"per-call latency reduction: {(1 - after / before) * 100:.1f}%")
+    server.shutdown()
+
+
+def bench_fanout(args):
+    """Wall time of a contents-mode find_readme_targets scan at several concurrency limits."""
+    def listing(request, body):
+        path = request.path.split("/contents/", 1)[1].split("?", 1)[0].strip("/")
+        if not path:
+            return 200, {}, [{"name": f"pkg_{i:03d}", "type": "dir"} for i in range(args.dirs)]
+        return 200, {}, [{"name": "main.py", "type": "file", "size": 100}]
+
+    server = start_stand_in([(_contents_route, listing)], delay=args.delay)
+    import mcp_server_v2 as srv
+
+    baseline = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        result = json.loads(srv.find_readme_targets("octo", "demo", max_workers=workers))
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"max_workers={workers:<3} targets={len(result['targets_identified']):<4} "
+              f"wall={elapsed:7.3f}s speedup={baseline / elapsed:5.1f}x")
+    server.shutdown()
+
+
+def bench_throttle(args):
+    """Drives the rate-limit scheduler with a stand-in that sends throttling headers."""
+    os.environ.setdefault("RATE_LIMIT_BACKOFF_BASE", "0.05")
+    state = {"served": 0, "remaining": args.budget}
+    reset_at = int(time.time()) + args.window
+
+    def throttled(request, body):
+        state["served"] += 1
+        if state["served"] <= 2:
+            return 429, {"Retry-After": "0"}, {"message": "secondary rate limit"}
+        if state["served"] == 3:
+            return 502, {}, {"message": "Server Error"}
+        state["remaining"] = max(0, state["remaining"] - 1)
+        headers = {
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Remaining": str(state["remaining"]),
+            "X-RateLimit-Used": str(5000 - state["remaining"]),
+            "X-RateLimit-Reset": str(reset_at),
+            "X-RateLimit-Resource": "core"
+        }
+        return 200, headers, [{"name": "main.py", "type": "file"}]
+
+    server = start_stand_in([(_contents_route, throttled)])
+    import mcp_server_v2 as srv
+
+    start = time.perf_counter()
+    results = [srv._get_contents("octo", "demo", f"dir_{i}") for i in range(args.calls)]
+    elapsed = time.perf_counter() - start
+    failures = sum(1 for r in results if isinstance(r, str))
+    print(f"calls={args.calls} failures={failures} upstream_requests={server.request_count} wall={elapsed:.2f}s")
+    print(srv.get_rate_limit_status())
+    server.shutdown()
+
+    problems = _check_pacing(srv)
+    if failures:
+        problems.append(f"{failures} calls failed despite retries")
+    if server.request_count != args.calls + 3:
+        problems.append(f"expected {args.calls + 3} upstream requests (3 retried), got {server.request_count}")
+    if problems:
+        sys.exit("FAIL: " + "; ".join(problems))
+    print("pacing checks passed")
+
+
+def _check_pacing(srv):
+    """Checks the scheduler's waits directly, without sleeping; returns a list of problems."""
+    problems = []
+    now = time.time()
+
+    def waits(scheduler, resource, method, count):
+        return [round(scheduler._wait_time("t", resource, method), 2) for _ in range(count)]
+
+    # 10 requests left for 10 seconds: one per second
+    scheduler = srv._RateLimitScheduler()
+    scheduler._budgets[("t", "core")] = {"limit": 5000, "remaining": 10, "used": 4990, "reset": now + 10}
+    got = waits(scheduler, "core", "GET", 4)
+    if any(abs(w - i) > 0.1 for i, w in enumerate(got)):
+        problems.append(f"low-budget GETs not spaced 1s apart: {got}")
+
+    # Writes keep WRITE_MIN_INTERVAL between them even with a full budget
+    scheduler = srv._RateLimitScheduler()
+    got = waits(scheduler, "core", "PUT", 3)
+    if any(abs(w - i * srv.WRITE_MIN_INTERVAL) > 0.1 for i, w in enumerate(got)):
+        problems.append(f"writes not spaced by WRITE_MIN_INTERVAL: {got}")
+
+    # A slot beyond the wait cap is clamped, so later callers are not pushed back by requests never sent
+    scheduler = srv._RateLimitScheduler()
+    interval = srv.RATE_LIMIT_MAX_WAIT
+    scheduler._budgets[("t", "core")] = {"limit": 5000, "remaining": 2, "used": 4998, "reset": now + 2 * interval}
+    got = waits(scheduler, "core", "GET", 4)
+    booked = scheduler._next_slot[("t", "core")] - time.time()
+    if max(got) > srv.RATE_LIMIT_MAX_WAIT or booked > srv.RATE_LIMIT_MAX_WAIT + interval + 1:
+        problems.append(f"capped waits still pushed the lane back: waits={got} next_slot_in={booked:.0f}s")
+    return problems
+
+
+def bench_graphql(args):
+    """Request count and wall time of a README scan: contents mode vs batched GraphQL."""
+    def listing(request, body):
+        path = request.path.split("/contents/", 1)[1].split("?", 1)[0].strip("/")
+        if not path:
+            return 200, {}, [{"name": f"pkg_{i:03d}", "type": "dir"} for i in range(args.dirs)]
+        return 200, {}, [{"name": "main.py", "type": "file", "size": 100}]
+
+    def tree_for(expression):
+        path = expression.split(":", 1)[1].strip("/")
+        if not path:
+            entries = [{"name": f"pkg_{i:03d}", "type": "tree", "path": f"pkg_{i:03d}", "object": {}}
+                       for i in range(args.dirs)]
+        else:
+            entries = [{"name": "main.py", "type": "blob", "path": f"{path}/main.py", "object": {"byteSize": 100}}]
+        return {"__typename": "Tree", "entries": entries}
+
+    def graphql(request, body):
+        variables = json.loads(body)["variables"]
+        objects = {f"o{key[1:]}": tree_for(value) for key, value in variables.items() if key.startswith("e")}
+        return 200, {}, {"data": {"repository": objects, "rateLimit": {"cost": 1, "remaining": 4999}}}
+
+    server = start_stand_in([(_contents_route, listing),
+                             (lambda method, path: method == "POST" and path == "/graphql", graphql)],
+                            delay=args.delay)
+    import mcp_server_v2 as srv
+
+    for mode in ("contents", "graphql"):
+        server.request_count = 0
+        start = time.perf_counter()
+        result = json.loads(srv.find_readme_targets("octo", "demo", scan_mode=mode))
+        elapsed = time.perf_counter() - start
+        print(f"scan_mode={mode:<9} targets={len(result['targets_identified']):<4} "
+              f"upstream_requests={server.request_count:<4} wall={elapsed:7.3f}s")
+    server.shutdown()
+
+
+_COLDSTART_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import mcp_server_v2 as srv
+imported = time.perf_counter()
+srv._prepare_for_traffic()
+ready = time.perf_counter()
+srv._get_contents("octo", "demo", "")
+first = time.perf_counter()
+srv._get_contents("octo", "demo", "src")
+second = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "prepare_ms": (ready - imported) * 1000,
+                  "first_request_ms": (first - ready) * 1000, "second_request_ms": (second - first) * 1000}))
+"""
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_coldstart(args):
+    """Import time and first-request latency of mcp_server_v2 in fresh interpreters."""
+    server = start_stand_in([(_contents_route, _contents_listing)], delay=args.delay)
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="0")
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    runs = []
+    for _ in range(args.runs):
+        probe = subprocess.run([sys.executable, "-c", _COLDSTART_PROBE], capture_output=True, text=True,
+                               cwd=here, env=env, check=True)
+        runs.append(json.loads(probe.stdout.strip().splitlines()[-1]))
+    server.shutdown()
+
+    record = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": _git_revision(),
+              "python": platform.python_version(), "runs": args.runs}
+    for key in runs[0]:
+        record[key] = round(statistics.median(r[key] for r in runs), 2)
+        print(f"{key:<20} p50={record[key]:9.2f}ms  min={min(r[key] for r in runs):9.2f}ms")
+
+    if args.history:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        previous = None
+        if os.path.exists(args.history):
+            with open(args.history, encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            previous = json.loads(lines[-1]) if lines else None
+        with open(args.history, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        if previous:
+            for key in ("import_ms", "first_request_ms"):
+                print(f"{key} vs {previous.get('revision')}: {record[key] - previous[key]:+.2f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    pool = sub.add_parser("pool", help="pooled session vs new connection per call")
+    pool.add_argument("--calls", type=int, default=200)
+    pool.add_argument("--delay", type=float, default=0.0, help="simulated server time (s)")
+    pool.set_defaults(func=bench_pool)
+
+    fanout = sub.add_parser("fanout", help="find_readme_targets wall time vs max_workers")
+    fanout.add_argument("--dirs", type=int, default=200)
+    fanout.add_argument("--delay", type=float, default=0.02, help="simulated GitHub latency (s)")
+    fanout.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    fanout.set_defaults(func=bench_fanout)
+
+    throttle = sub.add_parser("throttle", help="rate-limit scheduler against throttling headers")
+    throttle.add_argument("--calls", type=int, default=40)
+    throttle.add_argument("--budget", type=int, default=60, help="X-RateLimit-Remaining at start")
+    throttle.add_argument("--window", type=int, default=3, help="seconds until X-RateLimit-Reset")
+    throttle.set_defaults(func=bench_throttle)
+
+    graphql = sub.add_parser("graphql", help="find_readme_targets requests: contents vs GraphQL")
+    graphql.add_argument("--dirs", type=int, default=200)
+    graphql.add_argument("--delay", type=float, default=0.02, help="simulated GitHub latency (s)")
+    graphql.set_defaults(func=bench_graphql)
+
+    coldstart = sub.add_parser("coldstart", help="import time and first-request latency in a fresh process")
+    coldstart.add_argument("--runs", type=int, default=5)
+    coldstart.add_argument("--delay", type=float, default=0.0, help="simulated GitHub latency (s)")
+    coldstart.add_argument("--history", default=DEFAULT_HISTORY,
+                           help="append results here and compare with the previous entry ('' to skip)")
+    coldstart.set_defaults(func=bench_coldstart)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
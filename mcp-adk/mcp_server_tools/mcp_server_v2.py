@@ -6,95 +6,2173 @@ import base64
 import sys 
 from fastmcp import FastMCP, Context
 import traceback
-from typing import List, Dict, Any
-from github import Github, GithubException, Auth
+import threading
+import time
+import re
+import fnmatch
+import random
+import hashlib
+import io
+import tarfile
+import subprocess
+import tempfile
+import sqlite3
+import ast
+import contextlib
+import contextvars
+import asyncio
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from prometheus_client import Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from fastmcp.server.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import Response
 
 # --- Initialize the MCP Server ---
 mcp = FastMCP("githubexpertj8jan")
 
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 
+# --- Per-request credentials ---
+# A caller may send its own token in the X-GitHub-Token header; it is used for
+# that tool call only, with its own connection pool, rate-limit budget and cache
+# partition. GITHUB_TOKEN is the identity for callers that send none.
+GITHUB_TOKEN_HEADER = os.getenv("GITHUB_TOKEN_HEADER", "X-GitHub-Token").lower()
+HTTP_MAX_TOKEN_POOLS = int(os.getenv("HTTP_MAX_TOKEN_POOLS", 64))
+_request_token = contextvars.ContextVar("github_request_token", default=None)
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+
+# --- Shared HTTP connection pool ---
+# One keep-alive session for the whole process so repeated tool calls reuse
+# the TCP+TLS connection to the GitHub API instead of opening a new one each time.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 32))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+
+_http_sessions = OrderedDict()  # token key -> session, least recently used first
+_http_session_lock = threading.Lock()
+
+# Max in-flight GitHub requests when a tool fans out over many paths.
+SCAN_MAX_WORKERS = int(os.getenv("SCAN_MAX_WORKERS", 8))
+
+# --- Background scan jobs ---
+# start_scan runs find_readme_targets off the request path so large repos do
+# not hit the client's tool-call timeout. Finished results are reused per commit.
+SCAN_JOB_WORKERS = int(os.getenv("SCAN_JOB_WORKERS", 2))
+SCAN_RESULT_TTL_SECONDS = float(os.getenv("SCAN_RESULT_TTL_SECONDS", 3600))
+# With RESPONSE_CACHE_PATH set, jobs are visible to every worker; a running job
+# whose worker has not written progress for this long is reported as failed.
+SCAN_JOB_STALE_SECONDS = float(os.getenv("SCAN_JOB_STALE_SECONDS", 300))
+
+# --- Organization audits ---
+# audit_org_readmes scans many repos per call and saves a checkpoint after each
+# one, so a run cut short by time or rate limit resumes where it stopped. A repo
+# that failed is scanned again on later calls, up to ORG_AUDIT_MAX_ATTEMPTS times.
+ORG_AUDIT_MAX_ATTEMPTS = int(os.getenv("ORG_AUDIT_MAX_ATTEMPTS", 3))
+ORG_AUDIT_MAX_WORKERS = int(os.getenv("ORG_AUDIT_MAX_WORKERS", 4))
+ORG_AUDIT_BUDGET_RESERVE = int(os.getenv("ORG_AUDIT_BUDGET_RESERVE", 200))
+ORG_AUDIT_CHECKPOINT_DIR = os.getenv("ORG_AUDIT_CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "mcp-org-audits"))
+
+# --- Conditional-request (ETag) cache ---
+# 304 responses do not count against the GitHub rate limit, and a response
+# still inside its Cache-Control max-age is served without any request at all.
+GITHUB_CACHE_MAX_ENTRIES = int(os.getenv("GITHUB_CACHE_MAX_ENTRIES", 1024))
+GITHUB_CACHE_MAX_BYTES = int(os.getenv("GITHUB_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Optional second tier in SQLite, shared by every worker process on the host.
+# The same file also holds session state (ref pins, scan jobs) so any worker can serve any request.
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# --- Transport ---
+# sse: one process, long-lived connections (the default).
+# http: stateless streamable HTTP at /mcp, for several uvicorn workers behind a
+# load balancer. Set RESPONSE_CACHE_PATH too so session state (ref pins, scan jobs) is shared
+# and any worker can serve any request.
+MCP_TRANSPORT = os.getenv("MCP_TRANSPORT", "sse").lower()
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+
+# --- Rate-limit scheduler ---
+# Every outbound call is paced against the primary (X-RateLimit-*) and
+# secondary (Retry-After) budgets of the token it uses.
+RATE_LIMIT_LOW_WATERMARK = int(os.getenv("RATE_LIMIT_LOW_WATERMARK", 100))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", 4))
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", 1.0))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", 60))
+# GitHub asks for at least a second between content-creating requests
+WRITE_MIN_INTERVAL = float(os.getenv("WRITE_MIN_INTERVAL", 1.0))
+
+# --- Repository snapshots ---
+# With REPO_SNAPSHOT_MODE=1 the first read of a (repo, ref) downloads one
+# tarball and serves listings and file reads from memory afterwards.
+REPO_SNAPSHOT_MODE = os.getenv("REPO_SNAPSHOT_MODE", "0").lower() in ("1", "true", "on")
+SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", 900))
+SNAPSHOT_MAX_BYTES = int(os.getenv("SNAPSHOT_MAX_BYTES", 512 * 1024 * 1024))
+
+# --- Repository backend ---
+# "github" talks to the REST API; "local" reads and writes bare git
+# repositories under LOCAL_GIT_ROOT/<owner>/<repo>.git at disk speed.
+REPO_BACKEND = os.getenv("REPO_BACKEND", "github").lower()
+LOCAL_GIT_ROOT = os.getenv("LOCAL_GIT_ROOT", "/srv/git")
+
+# --- On-disk blob cache ---
+# Contents at a blob SHA never change, so they can be kept across restarts and
+# shared by every worker process on the host. Set BLOB_CACHE_PATH to enable.
+BLOB_CACHE_PATH = os.getenv("BLOB_CACHE_PATH", "")
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# path -> blob SHA indexes kept for that many recent trees (one per pinned commit)
+TREE_INDEX_MAX_ENTRIES = int(os.getenv("TREE_INDEX_MAX_ENTRIES", 32))
+
+# --- Pagination ---
+# GitHub list endpoints return 30 items unless asked; the contents API stops
+# listing a directory at 1000 entries.
+GITHUB_PER_PAGE = 100
+CONTENTS_LISTING_CAP = 1000
+COMPARE_MAX_FILES = 300
+
+# --- GraphQL batch fetch ---
+# One GraphQL query resolves dozens of "ref:path" objects (trees or blob text).
+# GITHUB_GRAPHQL=1 uses it for analyze_and_suggest_readme and read_files_batch;
+# find_readme_targets uses it with scan_mode="graphql". Failures fall back to REST.
+GITHUB_GRAPHQL = os.getenv("GITHUB_GRAPHQL", "0").lower() in ("1", "true", "on")
+GITHUB_GRAPHQL_URL = os.getenv("GITHUB_GRAPHQL_URL", f"{GITHUB_API_URL}/graphql")
+GRAPHQL_BATCH_SIZE = int(os.getenv("GRAPHQL_BATCH_SIZE", 50))
+GRAPHQL_BLOB_BATCH_SIZE = int(os.getenv("GRAPHQL_BLOB_BATCH_SIZE", 20))
+GRAPHQL_MAX_COST = int(os.getenv("GRAPHQL_MAX_COST", 10))
+
+# --- Symbol index ---
+# Python definitions and imports per commit, built from parsed blobs. Blobs are
+# cached by SHA, so indexing a new commit only parses the files that changed.
+SYMBOL_INDEX_MAX_BLOBS = int(os.getenv("SYMBOL_INDEX_MAX_BLOBS", 50000))
+SYMBOL_INDEX_MAX_COMMITS = int(os.getenv("SYMBOL_INDEX_MAX_COMMITS", 16))
+SYMBOL_INDEX_MAX_FILE_BYTES = int(os.getenv("SYMBOL_INDEX_MAX_FILE_BYTES", 1024 * 1024))
+
+# --- Ref pinning ---
+# A branch name is resolved to a commit SHA once per session (REF_PIN_TTL_SECONDS)
+# and every later read uses the SHA, so all steps of a run see the same commit
+# and their responses can be cached forever.
+REF_PINNING = os.getenv("REF_PINNING", "1").lower() in ("1", "true", "on")
+REF_PIN_TTL_SECONDS = float(os.getenv("REF_PIN_TTL_SECONDS", 900))
+# Refs that could not be resolved are read unpinned for this long before retrying
+REF_PIN_FAILURE_TTL_SECONDS = float(os.getenv("REF_PIN_FAILURE_TTL_SECONDS", 30))
+
 def _get_github_client():
-    """Lazy initialization of the GitHub client."""
-    if not GITHUB_TOKEN:
+    """
+    Lazy initialization of the GitHub client. PyGithub is imported here rather
+    than at module load (it is the slowest import on cold start), and no request
+    is made until the client is actually used.
+    """
+    token = _current_token()
+    if not token:
         return None
     try:
-        auth = Auth.Token(GITHUB_TOKEN)
-        client = Github(auth=auth)
-        client.get_rate_limit()
-        return client
+        from github import Github, Auth
+        return Github(auth=Auth.Token(token), base_url=GITHUB_API_URL)
     except Exception as e:
         print(f"ERROR: GitHub Client initialization failed: {e}", file=sys.stderr)
         return None
 
+def _current_token():
+    """The caller's token for this tool call, else the server's GITHUB_TOKEN."""
+    return _request_token.get() or GITHUB_TOKEN
+
 def _get_auth_headers():
     """Utility to ensure headers are created consistently for all requests calls."""
-    if not GITHUB_TOKEN:
-        raise ValueError("GITHUB_TOKEN environment variable is missing.")
+    token = _current_token()
+    if not token:
+        raise ValueError(f"GITHUB_TOKEN environment variable is missing (and no {GITHUB_TOKEN_HEADER} header was sent).")
     return {
-        "Authorization": f"token {GITHUB_TOKEN}", 
+        "Authorization": f"token {token}", 
         "Accept": "application/vnd.github.v3+json"
     }
 
-# UPDATED: Added 'ref' parameter to support branches
-def _get_contents(owner: str, repo: str, path: str = "", ref: str = None):
-    """Standard Python function to fetch repo contents."""
+def _partition() -> str:
+    """Cache partition for the current identity, so one caller never sees another's cached data."""
+    token = _current_token()
+    return _token_key({"Authorization": f"token {token}"} if token else None)
+
+def _get_http_session(token_key: str = None) -> requests.Session:
+    """
+    Returns the pooled session for a token, creating it on first use. Each token
+    gets its own pool so one busy identity cannot take every connection.
+    """
+    token_key = token_key or _partition()
+    with _http_session_lock:
+        session = _http_sessions.get(token_key)
+        if session is not None:
+            _http_sessions.move_to_end(token_key)
+            return session
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+            "User-Agent": "adk-github-mcp-server"
+        })
+        _http_sessions[token_key] = session
+        while len(_http_sessions) > HTTP_MAX_TOKEN_POOLS:
+            _http_sessions.popitem(last=False)  # idle sockets close when the session is collected
+        return session
+
+class _RateLimitScheduler:
+    """
+    Tracks per-token GitHub budgets, paces requests and decides on retries.
+    State is kept for the HTTP_MAX_TOKEN_POOLS most recently seen tokens, like the session pool.
+    """
+
+    _RETRYABLE_5XX_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE"}
+
+    def __init__(self):
+        self._budgets = {}          # (token_key, resource) -> latest X-RateLimit-* values
+        self._blocked_until = {}    # token_key -> epoch seconds (secondary limit / Retry-After)
+        self._next_slot = {}        # (token_key, lane) -> earliest epoch seconds for the next paced call
+        self._tokens = OrderedDict()  # token_key -> None, least recently seen first
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "paced_seconds": 0.0}
+
+    @staticmethod
+    def resource_for(url: str) -> str:
+        if url.endswith("/graphql"):
+            return "graphql"
+        if "/search/" in url:
+            return "search"
+        return "core"
+
+    def _touch(self, token_key: str):
+        """Marks a token as recently seen and forgets the least recently seen ones past the cap."""
+        self._tokens[token_key] = None
+        self._tokens.move_to_end(token_key)
+        while len(self._tokens) > HTTP_MAX_TOKEN_POOLS:
+            old, _ = self._tokens.popitem(last=False)
+            self._blocked_until.pop(old, None)
+            for table in (self._budgets, self._next_slot):
+                for key in [k for k in table if k[0] == old]:
+                    del table[key]
+
+    def _reserve_slot(self, key, interval: float, now: float) -> float:
+        """Books the next evenly spaced slot on a lane; returns how long to wait for it."""
+        # Callers never wait past RATE_LIMIT_MAX_WAIT, so book the time the request is really sent
+        slot = min(max(now, self._next_slot.get(key, 0.0)), now + RATE_LIMIT_MAX_WAIT)
+        self._next_slot[key] = slot + interval
+        return slot - now
+
+    def _wait_time(self, token_key: str, resource: str, method: str) -> float:
+        now = time.time()
+        wait = self._blocked_until.get(token_key, 0) - now
+        budget = self._budgets.get((token_key, resource))
+        if budget and budget["reset"] > now:
+            if budget["remaining"] <= 0:
+                wait = max(wait, budget["reset"] - now)
+            elif budget["remaining"] < RATE_LIMIT_LOW_WATERMARK:
+                # Spread what is left evenly over the rest of the window
+                interval = (budget["reset"] - now) / budget["remaining"]
+                wait = max(wait, self._reserve_slot((token_key, resource), interval, now))
+        if method != "GET" and resource != "graphql":  # GraphQL reads are POSTs too
+            wait = max(wait, self._reserve_slot((token_key, "write"), WRITE_MIN_INTERVAL, now))
+        return max(0.0, min(wait, RATE_LIMIT_MAX_WAIT))
+
+    def before_request(self, token_key: str, url: str, method: str):
+        with self._lock:
+            self._touch(token_key)
+            wait = self._wait_time(token_key, self.resource_for(url), method)
+            self.stats["requests"] += 1
+            self.stats["paced_seconds"] += wait
+        if wait:
+            time.sleep(wait)
+
+    def record(self, token_key: str, response: requests.Response):
+        headers = response.headers
+        with self._lock:
+            self._touch(token_key)
+            if "X-RateLimit-Remaining" in headers:
+                resource = headers.get("X-RateLimit-Resource") or self.resource_for(response.url)
+                self._budgets[(token_key, resource)] = {
+                    "limit": int(headers.get("X-RateLimit-Limit", 0)),
+                    "remaining": int(headers["X-RateLimit-Remaining"]),
+                    "used": int(headers.get("X-RateLimit-Used", 0)),
+                    "reset": int(headers.get("X-RateLimit-Reset", 0))
+                }
+            retry_after = headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                self._blocked_until[token_key] = time.time() + int(retry_after)
+
+    def record_rate_limit_payload(self, token_key: str, payload: dict):
+        """Stores budgets from GET /rate_limit (which is itself free)."""
+        with self._lock:
+            self._touch(token_key)
+            for resource, values in payload.get("resources", {}).items():
+                self._budgets[(token_key, resource)] = {
+                    "limit": values.get("limit", 0),
+                    "remaining": values.get("remaining", 0),
+                    "used": values.get("used", 0),
+                    "reset": values.get("reset", 0)
+                }
+
+    def remaining(self, token_key: str, resource: str = "core"):
+        """Requests left in the current window, or None if unknown or the window has reset."""
+        with self._lock:
+            budget = self._budgets.get((token_key, resource))
+            if budget is None or budget["reset"] <= time.time():
+                return None
+            return budget["remaining"]
+
+    def retry_delay(self, response: requests.Response, method: str, attempt: int):
+        """Seconds to wait before retrying, or None if the response is final."""
+        status = response.status_code
+        headers = response.headers
+        if status in (403, 429):
+            retry_after = headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = float(retry_after)
+            elif headers.get("X-RateLimit-Remaining") == "0":
+                delay = max(0.0, int(headers.get("X-RateLimit-Reset", 0)) - time.time())
+            elif status == 429 or "rate limit" in response.text.lower():
+                delay = RATE_LIMIT_BACKOFF_BASE * (2 ** attempt)
+            else:
+                return None  # a real permission error
+            with self._lock:
+                self.stats["throttled"] += 1
+        elif status >= 500 and method in self._RETRYABLE_5XX_METHODS:
+            delay = RATE_LIMIT_BACKOFF_BASE * (2 ** attempt)
+        else:
+            return None
+        if delay > RATE_LIMIT_MAX_WAIT:
+            return None  # waiting longer would outlive the tool call
+        with self._lock:
+            self.stats["retries"] += 1
+        return delay + random.uniform(0, RATE_LIMIT_BACKOFF_BASE)
+
+    def all_budgets(self) -> dict:
+        """token_key -> resource -> budget for every tracked token; for the metrics endpoint only."""
+        now = time.time()
+        with self._lock:
+            budgets = {}
+            for (token_key, resource), budget in self._budgets.items():
+                budgets.setdefault(token_key, {})[resource] = dict(
+                    budget, resets_in_seconds=max(0, int(budget["reset"] - now)))
+            return budgets
+
+    def snapshot(self, token_key: str) -> dict:
+        """Budgets for one token only, so a caller never sees another identity's usage."""
+        now = time.time()
+        with self._lock:
+            budgets = {resource: dict(budget, resets_in_seconds=max(0, int(budget["reset"] - now)))
+                       for (key, resource), budget in self._budgets.items() if key == token_key}
+            blocked = max(0.0, round(self._blocked_until.get(token_key, 0) - now, 1))
+            return {"budgets": budgets, "secondary_blocked_seconds": blocked,
+                    "stats": dict(self.stats, paced_seconds=round(self.stats["paced_seconds"], 3))}
+
+_rate_limiter = _RateLimitScheduler()
+
+def _token_key(headers: dict = None) -> str:
+    """Short, non-reversible id for the token in an Authorization header."""
+    auth = (headers or {}).get("Authorization", "")
+    return hashlib.sha256(auth.encode("utf-8")).hexdigest()[:12] if auth else "anonymous"
+
+def _http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Sends a request through the shared session with a default timeout.
+    Calls are paced by the rate-limit scheduler, and throttled (403/429) or
+    failed (5xx) responses are retried with jittered backoff.
+    """
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    token_key = _token_key(kwargs.get("headers"))
+    with _span(f"GitHub {method} {_endpoint_label(url)}", {"http.request.method": method, "url.full": url}) as span:
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            _rate_limiter.before_request(token_key, url, method)
+            response = _get_http_session(token_key).request(method, url, **kwargs)
+            _rate_limiter.record(token_key, response)
+            _observe_upstream(method, url, response, streamed=kwargs.get("stream", False))
+            if attempt == RATE_LIMIT_MAX_RETRIES:
+                break
+            delay = _rate_limiter.retry_delay(response, method, attempt)
+            if delay is None:
+                break
+            print(f"WARN: GitHub returned {response.status_code} for {method} {url}; retrying in {delay:.1f}s", file=sys.stderr)
+            time.sleep(delay)
+        if span is not None:
+            span.set_attribute("http.response.status_code", response.status_code)
+            span.set_attribute("http.request.resend_count", attempt)
+    return response
+
+class _ResponseCache:
+    """Bounded LRU of GET responses keyed by token, URL, params and Accept header."""
+
+    _MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(url: str, params: dict = None, headers: dict = None):
+        accept = (headers or {}).get("Accept", "")
+        return (_token_key(headers), url, tuple(sorted((params or {}).items())), accept)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def is_fresh(self, entry) -> bool:
+        return time.monotonic() - entry["stored_at"] < entry["max_age"]
+
+    def store(self, key, response: requests.Response, immutable: bool = False, age: float = 0.0):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified and not immutable:
+            return None
+        match = self._MAX_AGE_RE.search(response.headers.get("Cache-Control", ""))
+        entry = {
+            "response": response,
+            "etag": etag,
+            "last_modified": last_modified,
+            "max_age": float("inf") if immutable else (int(match.group(1)) if match else 0),
+            "stored_at": time.monotonic() - age,
+            "size": len(response.content)
+        }
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old["size"]
+            self._entries[key] = entry
+            self._bytes += entry["size"]
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted["size"]
+                self.stats["evictions"] += 1
+        return entry
+
+    def touch(self, entry):
+        entry["stored_at"] = time.monotonic()
+
+    def invalidate(self, url_prefix: str):
+        """Forces revalidation (not removal) of every mutable entry under a URL prefix."""
+        with self._lock:
+            for (_, url, _, _), entry in self._entries.items():
+                if url.startswith(url_prefix) and entry["max_age"] != float("inf"):
+                    entry["stored_at"] = float("-inf")
+
+    def count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["revalidated"] + self.stats["misses"]
+            served = self.stats["hits"] + self.stats["revalidated"]
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes,
+                        hit_ratio=round(served / lookups, 4) if lookups else 0.0)
+
+_response_cache = _ResponseCache(GITHUB_CACHE_MAX_ENTRIES, GITHUB_CACHE_MAX_BYTES)
+
+class _SqliteStore:
+    """
+    SQLite file shared by every worker process on the host. WAL mode plus a busy
+    timeout makes concurrent access safe; each thread gets its own connection.
+    With 'table' and max_bytes set, the table is trimmed oldest-first by
+    'order_column'. Its total size is kept in store_sizes by triggers, so
+    writes never sum the whole table.
+    """
+    table = None
+    key_column = None
+    order_column = None
+
+    def __init__(self, path: str, schema: tuple, max_bytes: int = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._transaction() as conn:
+            for statement in schema:
+                conn.execute(statement)
+            if self.table and max_bytes:
+                t = self.table
+                conn.execute("CREATE TABLE IF NOT EXISTS store_sizes (name TEXT PRIMARY KEY, bytes INTEGER NOT NULL)")
+                # Seeds the counter once for tables created before it existed
+                conn.execute(f"INSERT OR IGNORE INTO store_sizes SELECT ?, COALESCE(SUM(size), 0) FROM {t}", (t,))
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {t}_size_insert AFTER INSERT ON {t} BEGIN
+                    UPDATE store_sizes SET bytes = bytes + new.size WHERE name = '{t}'; END""")
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {t}_size_delete AFTER DELETE ON {t} BEGIN
+                    UPDATE store_sizes SET bytes = bytes - old.size WHERE name = '{t}'; END""")
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {t}_size_update AFTER UPDATE OF size ON {t} BEGIN
+                    UPDATE store_sizes SET bytes = bytes + new.size - old.size WHERE name = '{t}'; END""")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _count(self, stat: str, n: int = 1):
+        with self._lock:
+            self.stats[stat] += n
+
+    def _total_bytes(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT bytes FROM store_sizes WHERE name = ?", (self.table,)).fetchone()[0]
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        """Inside a write transaction: trims to 90% of max_bytes so we do not evict on every insert."""
+        total = self._total_bytes(conn)
+        if total <= self.max_bytes:
+            return 0
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while total > target:
+            rows = conn.execute(f"SELECT {self.key_column}, size FROM {self.table} "
+                                f"ORDER BY {self.order_column} LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= target:
+                    break
+                conn.execute(f"DELETE FROM {self.table} WHERE {self.key_column} = ?", (key,))
+                total -= size
+                evicted += 1
+        return evicted
+
+    def snapshot(self) -> dict:
+        conn = self._connect()
+        entries = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        size = self._total_bytes(conn)
+        with self._lock:
+            return dict(self.stats, entries=entries, bytes=size, path=self.path)
+
+class _SharedResponseStore(_SqliteStore):
+    """SQLite tier behind _ResponseCache so worker processes share cached GETs (and their ETags)."""
+    table, key_column, order_column = "responses", "key", "stored_at"
+
+    def __init__(self, path: str, max_bytes: int):
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        super().__init__(path, (
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, url TEXT NOT NULL, headers TEXT NOT NULL, body BLOB NOT NULL,
+                immutable INTEGER NOT NULL, size INTEGER NOT NULL, stored_at REAL NOT NULL)""",
+            "CREATE INDEX IF NOT EXISTS responses_age ON responses (stored_at)",
+        ), max_bytes)
+
+    @staticmethod
+    def _db_key(key) -> str:
+        return json.dumps(key)
+
+    def get(self, key):
+        """Returns (response, immutable, age_seconds) or None."""
+        row = self._connect().execute(
+            "SELECT url, headers, body, immutable, stored_at FROM responses WHERE key = ?",
+            (self._db_key(key),)).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        url, headers, body, immutable, stored_at = row
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = requests.structures.CaseInsensitiveDict(json.loads(headers))
+        response._content = bytes(body)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        self._count("hits")
+        return response, bool(immutable), max(0.0, time.time() - stored_at)
+
+    def put(self, key, response: requests.Response, immutable: bool):
+        body = response.content
+        with self._transaction() as conn:
+            # Upsert rather than REPLACE: REPLACE's implicit delete does not fire the size triggers
+            conn.execute(
+                "INSERT INTO responses (key, url, headers, body, immutable, size, stored_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET url = excluded.url, "
+                "headers = excluded.headers, body = excluded.body, immutable = excluded.immutable, "
+                "size = excluded.size, stored_at = excluded.stored_at",
+                (self._db_key(key), key[1], json.dumps(dict(response.headers)), sqlite3.Binary(body),
+                 int(immutable), len(body), time.time()))
+            evicted = self._evict(conn)
+        self._count("stored")
+        self._count("evicted", evicted)
+
+    def touch(self, key):
+        """Records a 304 so other workers also treat the entry as fresh."""
+        self._connect().execute("UPDATE responses SET stored_at = ? WHERE key = ?", (time.time(), self._db_key(key)))
+
+    def invalidate(self, url_prefix: str):
+        self._connect().execute("UPDATE responses SET stored_at = 0 WHERE immutable = 0 AND substr(url, 1, ?) = ?",
+                                (len(url_prefix), url_prefix))
+
+_shared_responses = _SharedResponseStore(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES) if RESPONSE_CACHE_PATH else None
+
+class _SharedState(_SqliteStore):
+    """Per-session state that must look the same from every worker process."""
+
+    def __init__(self, path: str):
+        super().__init__(path, (
+            "CREATE TABLE IF NOT EXISTS ref_pins (key TEXT PRIMARY KEY, sha TEXT NOT NULL, pinned_at REAL NOT NULL)",
+            """CREATE TABLE IF NOT EXISTS scan_jobs (job_id TEXT PRIMARY KEY, scan_key TEXT NOT NULL,
+                status TEXT NOT NULL, job TEXT NOT NULL, updated_at REAL NOT NULL)""",
+            "CREATE INDEX IF NOT EXISTS scan_jobs_key ON scan_jobs (scan_key, status)",
+            """CREATE TABLE IF NOT EXISTS scan_results (scan_key TEXT PRIMARY KEY, result TEXT NOT NULL,
+                finished_at REAL NOT NULL)""",
+        ))
+
+    def get_pin(self, key: str):
+        row = self._connect().execute("SELECT sha, pinned_at FROM ref_pins WHERE key = ?", (key,)).fetchone()
+        return {"sha": row[0], "pinned_at": row[1]} if row else None
+
+    def set_pin(self, key: str, sha: str, pinned_at: float):
+        self._connect().execute("INSERT OR REPLACE INTO ref_pins (key, sha, pinned_at) VALUES (?, ?, ?)",
+                                (key, sha, pinned_at))
+
+    def drop_pin(self, key: str):
+        self._connect().execute("DELETE FROM ref_pins WHERE key = ?", (key,))
+
+    def put_job(self, scan_key: str, job: dict):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO scan_jobs (job_id, scan_key, status, job, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (job["job_id"], scan_key, job["status"], json.dumps(job), time.time()))
+
+    def get_job(self, job_id: str):
+        """Returns (job, updated_at) or None."""
+        row = self._connect().execute("SELECT job, updated_at FROM scan_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def active_job(self, scan_key: str, updated_after: float):
+        row = self._connect().execute(
+            "SELECT job FROM scan_jobs WHERE scan_key = ? AND status IN ('queued', 'running') AND updated_at > ? "
+            "ORDER BY updated_at DESC LIMIT 1", (scan_key, updated_after)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_scan_result(self, scan_key: str, result: dict, finished_at: float):
+        self._connect().execute("INSERT OR REPLACE INTO scan_results (scan_key, result, finished_at) VALUES (?, ?, ?)",
+                                (scan_key, json.dumps(result), finished_at))
+
+    def get_scan_result(self, scan_key: str, finished_after: float):
+        row = self._connect().execute("SELECT result FROM scan_results WHERE scan_key = ? AND finished_at > ?",
+                                      (scan_key, finished_after)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def expire_scans(self, before: float):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM scan_jobs WHERE updated_at < ?", (before,))
+            conn.execute("DELETE FROM scan_results WHERE finished_at < ?", (before,))
+
+_shared_state = _SharedState(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+
+class _SingleFlight:
+    """
+    Collapses concurrent identical calls into one: the first caller for a key
+    runs it, later callers wait and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+                self.stats["leaders"] += 1
+                leader = True
+            else:
+                self.stats["coalesced"] += 1
+                leader = False
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._calls))
+
+_inflight = _SingleFlight()
+
+_SHA_RE = re.compile(r"[0-9a-f]{40}")
+_IMMUTABLE_URL_RE = re.compile(r"/git/(trees|blobs|commits)/[0-9a-f]{40}$|/compare/[0-9a-f]{40}\.\.\.[0-9a-f]{40}$")
+
+def _is_immutable(url: str, params: dict = None) -> bool:
+    """Responses addressed by commit/tree/blob SHA can never change."""
+    return bool(_SHA_RE.fullmatch((params or {}).get("ref") or "") or _IMMUTABLE_URL_RE.search(url))
+
+def _github_get(url: str, headers: dict = None, params: dict = None, use_cache: bool = True) -> requests.Response:
+    """
+    GET with conditional-request caching.
+    Fresh entries are served from memory; stale ones are revalidated with
+    If-None-Match / If-Modified-Since and reused on a 304. Identical requests
+    already in flight (same token, URL, params and Accept) share one upstream call.
+    """
+    headers = dict(headers or _get_auth_headers())
+    key = _ResponseCache.make_key(url, params, headers)
+    flight_key = (use_cache,) + key
+    if not use_cache:
+        return _inflight.do(flight_key, lambda: _http_request("GET", url, headers=headers, params=params))
+    return _inflight.do(flight_key, lambda: _cached_get(key, url, headers, params))
+
+def _cached_get(key, url: str, headers: dict, params: dict = None) -> requests.Response:
+    entry = _response_cache.get(key)
+    if entry is None and _shared_responses is not None:
+        shared = _shared_responses.get(key)
+        if shared is not None:
+            response, immutable, age = shared
+            entry = _response_cache.store(key, response, immutable=immutable, age=age)
+    if entry is not None:
+        if _response_cache.is_fresh(entry):
+            _response_cache.count("hits")
+            return entry["response"]
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = _http_request("GET", url, headers=headers, params=params)
+    if response.status_code == 304 and entry is not None:
+        _response_cache.touch(entry)
+        _response_cache.count("revalidated")
+        if _shared_responses is not None:
+            _shared_responses.touch(key)
+        return entry["response"]
+
+    _response_cache.count("misses")
+    if response.status_code == 200:
+        immutable = _is_immutable(url, params)
+        if _response_cache.store(key, response, immutable=immutable) is not None and _shared_responses is not None:
+            _shared_responses.put(key, response, immutable)
+    return response
+
+def _encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode("ascii")
+
+def _decode_cursor(cursor: str) -> dict:
+    """
+    Cursors only carry a page number and an offset; the URL is always rebuilt
+    server-side, so a client-supplied cursor cannot redirect authenticated requests.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        raise ValueError("Invalid cursor.") from None
+    if (not isinstance(state, dict) or not set(state) <= {"page", "offset"}
+            or not all(isinstance(v, int) and v >= 0 for v in state.values())):
+        raise ValueError("Invalid cursor.")
+    return state
+
+def _iter_pages(url: str, params: dict = None, headers: dict = None, items_key: str = None, page: int = 1):
+    """
+    Streams a list endpoint page by page (per_page=100) starting at 'page', following Link rel="next".
+    Yields (page number, next_url, items).
+    """
+    params = dict(params or {}, per_page=GITHUB_PER_PAGE)
+    if page > 1:
+        params["page"] = page
+    page_url = requests.Request("GET", url, params=params).prepare().url
+    while page_url:
+        response = _github_get(page_url, headers=headers or _get_auth_headers())
+        response.raise_for_status()
+        data = response.json()
+        next_url = response.links.get("next", {}).get("url")
+        yield page, next_url, (data.get(items_key, []) if items_key else data)
+        page_url, page = next_url, page + 1
+
+def _github_get_paginated(url: str, params: dict = None, cursor: str = None, limit: int = None,
+                          headers: dict = None, items_key: str = None):
+    """
+    Collects up to 'limit' items from a list endpoint, starting at 'cursor'.
+    Returns (items, next_cursor); next_cursor is None once the listing is exhausted.
+    The same url and params must be passed again with the cursor.
+    """
+    state = _decode_cursor(cursor) if cursor else {}
+    offset = state.get("offset", 0)
+    pages = _iter_pages(url, params, headers=headers, items_key=items_key, page=max(1, state.get("page", 1)))
+
+    items = []
+    for page_number, next_url, page in pages:
+        page = page[offset:]
+        start, offset = offset, 0
+        if limit is not None and len(items) + len(page) >= limit:
+            take = limit - len(items)
+            items.extend(page[:take])
+            if take < len(page):
+                return items, _encode_cursor({"page": page_number, "offset": start + take})
+            return items, _encode_cursor({"page": page_number + 1, "offset": 0}) if next_url else None
+        items.extend(page)
+    return items, None
+
+def _slice_listing(items: list, cursor: str = None, limit: int = None):
+    """Cursor/limit paging over a listing that is already in memory."""
+    start = _decode_cursor(cursor).get("offset", 0) if cursor else 0
+    end = len(items) if limit is None else start + limit
+    next_cursor = _encode_cursor({"offset": end}) if end < len(items) else None
+    return items[start:end], next_cursor
+
+def _run_concurrently(fn, items: list, max_workers: int = None) -> list:
+    """Maps fn over items with bounded concurrency; results keep the input order."""
+    items = list(items)
+    workers = max(1, min(max_workers or SCAN_MAX_WORKERS, len(items)))
+    if workers == 1:
+        return [fn(item) for item in items]
+    # Worker threads start with an empty context; run each call in a copy of
+    # the caller's so the active trace span carries over.
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda item: context.copy().run(fn, item), items))
+
+def _invalidate_repo_cache(owner: str, repo: str):
+    """Called after writes so the next read revalidates instead of trusting max-age."""
+    _response_cache.invalidate(f"{GITHUB_API_URL}/repos/{owner}/{repo}/")
+    if _shared_responses is not None:
+        _shared_responses.invalidate(f"{GITHUB_API_URL}/repos/{owner}/{repo}/")
+    _snapshots.drop_repo(owner, repo)
+
+class _SnapshotTooLarge(ValueError):
+    """The archive or its extracted files exceed SNAPSHOT_MAX_BYTES."""
+
+class _RepoSnapshot:
+    """In-memory path index of one commit, built from its tarball."""
+
+    def __init__(self, owner: str, repo: str, ref: str, commit_sha: str, archive: bytes, max_bytes: int = None):
+        self.owner, self.repo, self.ref, self.commit_sha = owner, repo, ref, commit_sha
+        self.created_at = time.monotonic()
+        self.files = {}                 # path -> bytes
+        self.dirs = {"": {}}            # dir path -> {name: entry}
+        self.size = 0
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:*") as tar:
+            for member in tar:
+                # GitHub prefixes every member with '<owner>-<repo>-<sha>/'
+                _, _, path = member.name.partition("/")
+                path = path.strip("/")
+                if not path:
+                    continue
+                if member.isdir():
+                    self._add_dir(path)
+                elif member.isfile():
+                    self.size += member.size
+                    if max_bytes is not None and self.size > max_bytes:
+                        raise _SnapshotTooLarge(f"{owner}/{repo}@{commit_sha[:7]} extracts to more than {max_bytes} bytes")
+                    data = tar.extractfile(member).read()
+                    self.files[path] = data
+                    parent, _, name = path.rpartition("/")
+                    self._add_dir(parent)
+                    self.dirs[parent][name] = {
+                        "name": name, "path": path, "type": "file", "size": len(data),
+                        "sha": _git_blob_sha(data)
+                    }
+
+    def _add_dir(self, path: str):
+        if path in self.dirs:
+            return
+        self.dirs[path] = {}
+        parent, _, name = path.rpartition("/")
+        self._add_dir(parent)
+        self.dirs[parent][name] = {"name": name, "path": path, "type": "dir", "size": 0}
+
+    def list_contents(self, path: str = ""):
+        """Mimics the contents API: a list for directories, a dict for files, None if missing."""
+        path = path.strip("/")
+        if path in self.dirs:
+            return sorted(self.dirs[path].values(), key=lambda e: e["name"])
+        if path in self.files:
+            parent, _, name = path.rpartition("/")
+            return self.dirs[parent][name]
+        return None
+
+    def read(self, path: str):
+        return self.files.get(path.strip("/"))
+
+    def tree_entries(self) -> list:
+        """Same shape as a recursive Trees API listing."""
+        entries = [{"path": p, "type": "tree"} for p in self.dirs if p]
+        for parent, children in self.dirs.items():
+            entries.extend({"path": e["path"], "type": "blob", "sha": e["sha"], "size": e["size"]}
+                           for e in children.values() if e["type"] == "file")
+        return entries
+
+class _SnapshotStore:
+    """
+    Snapshots keyed by (partition, owner, repo, ref), evicted by age and total size.
+    A repo@ref whose archive does not fit in max_bytes is remembered for max_age
+    and read over REST instead of being downloaded again on every call.
+    """
+
+    _MAX_OVERSIZED = 1024
+
+    def __init__(self, max_age: float, max_bytes: int):
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._snapshots = OrderedDict()
+        self._oversized = OrderedDict()  # same key -> monotonic time the archive was found too large
+        self._building = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "builds": 0, "evictions": 0, "oversized": 0}
+
+    def is_oversized(self, owner: str, repo: str, ref: str = None) -> bool:
+        with self._lock:
+            found_at = self._oversized.get((_partition(), owner, repo, ref or ""))
+        return found_at is not None and time.monotonic() - found_at < self.max_age
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, snap in self._snapshots.items() if now - snap.created_at > self.max_age]:
+            del self._snapshots[key]
+            self.stats["evictions"] += 1
+        while self._snapshots and sum(s.size for s in self._snapshots.values()) > self.max_bytes:
+            self._snapshots.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, owner: str, repo: str, ref: str = None):
+        with self._lock:
+            self._evict()
+            key = (_partition(), owner, repo, ref or "")
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None:
+                self._snapshots.move_to_end(key)
+                self.stats["hits"] += 1
+            return snapshot
+
+    def load(self, owner: str, repo: str, ref: str = None):
+        """
+        Returns the snapshot, downloading it once even if several threads ask at the
+        same time, or None if it is too large to keep (callers then use REST).
+        """
+        key = (_partition(), owner, repo, ref or "")
+        snapshot = self.get(owner, repo, ref)
+        if snapshot is not None or self.is_oversized(owner, repo, ref):
+            return snapshot
+        with self._lock:
+            build_lock = self._building.setdefault(key, threading.Lock())
+        try:
+            with build_lock:
+                snapshot = self.get(owner, repo, ref)
+                if snapshot is None and not self.is_oversized(owner, repo, ref):
+                    try:
+                        snapshot = _download_snapshot(owner, repo, ref, self.max_bytes)
+                    except _SnapshotTooLarge as e:
+                        print(f"WARN: Not snapshotting {e}; reading over REST.", file=sys.stderr)
+                        with self._lock:
+                            self._oversized[key] = time.monotonic()
+                            self._oversized.move_to_end(key)
+                            while len(self._oversized) > self._MAX_OVERSIZED:
+                                self._oversized.popitem(last=False)
+                            self.stats["oversized"] += 1
+                        return None
+                    with self._lock:
+                        self._snapshots[key] = snapshot
+                        self.stats["builds"] += 1
+                        self._evict()
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+        return snapshot
+
+    def drop_repo(self, owner: str, repo: str):
+        with self._lock:
+            for key in [k for k in self._snapshots if k[1:3] == (owner, repo)]:
+                del self._snapshots[key]
+
+    def snapshot_stats(self) -> dict:
+        """Counters for every caller, but only the current partition's snapshots."""
+        partition = _partition()
+        with self._lock:
+            return dict(self.stats, snapshots=[
+                {"repo": f"{s.owner}/{s.repo}", "ref": s.ref, "commit": s.commit_sha,
+                 "files": len(s.files), "bytes": s.size,
+                 "age_seconds": round(time.monotonic() - s.created_at, 1)}
+                for key, s in self._snapshots.items() if key[0] == partition
+            ])
+
+_snapshots = _SnapshotStore(SNAPSHOT_MAX_AGE_SECONDS, SNAPSHOT_MAX_BYTES)
+
+def _download_snapshot(owner: str, repo: str, ref: str = None, max_bytes: int = None) -> _RepoSnapshot:
+    """
+    Resolves ref to a commit, then downloads that commit's tarball once.
+    Raises _SnapshotTooLarge as soon as the archive passes max_bytes.
+    """
+    headers = _get_auth_headers()
+    commit_sha = _GitHubRestBackend().resolve_ref(owner, repo, ref)
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/tarball/{commit_sha}"
+    too_large = _SnapshotTooLarge(f"{owner}/{repo}@{commit_sha[:7]} archive is larger than {max_bytes} bytes")
+    with _http_request("GET", url, headers=headers, stream=True) as archive:
+        archive.raise_for_status()
+        length = archive.headers.get("Content-Length")
+        if max_bytes is not None and length and length.isdigit() and int(length) > max_bytes:
+            raise too_large
+        chunks, total = [], 0
+        for chunk in archive.iter_content(chunk_size=1024 * 1024):
+            total += len(chunk)
+            if max_bytes is not None and total > max_bytes:
+                raise too_large
+            chunks.append(chunk)
+    return _RepoSnapshot(owner, repo, ref, commit_sha, b"".join(chunks), max_bytes)
+
+class _BlobCache(_SqliteStore):
+    """Content-addressed SQLite store keyed by git blob SHA, with LRU eviction by total size."""
+    table, key_column, order_column = "blobs", "sha", "last_access"
+
+    def __init__(self, path: str, max_bytes: int):
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        super().__init__(path, (
+            """CREATE TABLE IF NOT EXISTS blobs (
+                sha TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)""",
+            "CREATE INDEX IF NOT EXISTS blobs_lru ON blobs (last_access)",
+        ), max_bytes)
+
+    def get(self, sha: str):
+        conn = self._connect()
+        row = conn.execute("SELECT data FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        conn.execute("UPDATE blobs SET last_access = ? WHERE sha = ?", (time.time(), sha))
+        self._count("hits")
+        return bytes(row[0])
+
+    def put(self, sha: str, data: bytes):
+        with self._transaction() as conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO blobs (sha, data, size, last_access) VALUES (?, ?, ?, ?)",
+                (sha, sqlite3.Binary(data), len(data), time.time())).rowcount
+            evicted = self._evict(conn) if inserted else 0
+        self._count("stored", inserted)
+        self._count("evicted", evicted)
+
+_blob_cache = _BlobCache(BLOB_CACHE_PATH, BLOB_CACHE_MAX_BYTES) if BLOB_CACHE_PATH else None
+
+def _git_blob_sha(data: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+_tree_indexes = OrderedDict()  # (owner, repo, ref) -> (tree ETag, {path: blob sha}), LRU order
+_tree_indexes_lock = threading.Lock()
+
+def _blob_sha_for(owner: str, repo: str, path: str, ref: str = None):
+    """Resolves path -> blob SHA from the (ETag-cached) recursive tree of 'ref'."""
+    key = (owner, repo, ref or "HEAD")
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees/{ref or 'HEAD'}"
+    response = _github_get(url, headers=_get_auth_headers(), params={"recursive": "1"})
+    response.raise_for_status()
+    etag = response.headers.get("ETag")
+    with _tree_indexes_lock:
+        cached = _tree_indexes.get(key)
+        if cached is not None:
+            _tree_indexes.move_to_end(key)
+    if cached is not None and etag and cached[0] == etag:
+        index = cached[1]
+    else:
+        data = response.json()
+        if data.get("truncated"):
+            entries, _ = _list_tree_entries(owner, repo, ref)
+        else:
+            entries = data.get("tree", [])
+        index = {e["path"]: e["sha"] for e in entries if e.get("type") == "blob"}
+        with _tree_indexes_lock:
+            _tree_indexes[key] = (etag, index)
+            _tree_indexes.move_to_end(key)
+            while len(_tree_indexes) > TREE_INDEX_MAX_ENTRIES:
+                _tree_indexes.popitem(last=False)
+    return index.get(path.strip("/"))
+
+def _read_blob_cached(owner: str, repo: str, sha: str) -> bytes:
+    """Serves a blob from the disk cache, downloading and storing it on a miss."""
+    data = _blob_cache.get(sha)
+    if data is not None:
+        return data
+    headers = _get_auth_headers()
+    headers["Accept"] = "application/vnd.github.raw"
+    response = _github_get(f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/blobs/{sha}", headers=headers, use_cache=False)
+    response.raise_for_status()
+    data = response.content
+    if _git_blob_sha(data) == sha:
+        _blob_cache.put(sha, data)
+    return data
+
+def _snapshot_for(owner: str, repo: str, ref: str = None):
+    """The snapshot to serve from: auto-built in snapshot mode, else only if preloaded."""
+    if REPO_SNAPSHOT_MODE:
+        return _snapshots.load(owner, repo, ref)
+    return _snapshots.get(owner, repo, ref)
+
+class _GitHubRestBackend:
+    """Repository backend for the GitHub REST API (the default)."""
+
+    def list_contents(self, owner: str, repo: str, path: str = "", ref: str = None):
+        snapshot = _snapshot_for(owner, repo, ref)
+        if snapshot is not None:
+            listing = snapshot.list_contents(path)
+            if listing is None:
+                raise FileNotFoundError(f"404 Not Found: {path}")
+            return listing
+        url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/contents/{path}"
+        params = {"ref": ref} if ref else {}
+        response = _github_get(url, headers=_get_auth_headers(), params=params)
+        response.raise_for_status()
+        listing = response.json()
+        if isinstance(listing, list) and len(listing) >= CONTENTS_LISTING_CAP:
+            # The contents API silently stops at 1000 entries; the Trees API does not
+            listing = self._list_dir_via_tree(owner, repo, path, ref)
+        return listing
+
+    def _list_dir_via_tree(self, owner: str, repo: str, path: str, ref: str = None) -> list:
+        path = path.strip("/")
+        tree = _get_tree(owner, repo, f"{ref or 'HEAD'}:{path}", recursive=False)
+        return [
+            {"name": e["path"], "path": f"{path}/{e['path']}".strip("/"), "sha": e.get("sha"),
+             "size": e.get("size", 0), "type": "dir" if e["type"] == "tree" else "file"}
+            for e in tree.get("tree", [])
+        ]
+
+    def list_tree(self, owner: str, repo: str, ref: str = None, max_depth: int = None):
+        snapshot = _snapshot_for(owner, repo, ref)
+        if snapshot is not None:
+            return snapshot.tree_entries(), False
+        return _list_tree_entries(owner, repo, ref, max_depth=max_depth)
+
+    def changed_files(self, owner: str, repo: str, base: str, head: str):
+        """
+        Returns ([{path, status, previous_path}], method). Uses the compare API
+        when base is an ancestor of head and the file list is complete (GitHub
+        stops at 300 files); otherwise diffs the two trees.
+        """
+        url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/compare/{base}...{head}"
+        response = _github_get(url, headers=_get_auth_headers())
+        response.raise_for_status()
+        data = response.json()
+        files = data.get("files") or []
+        if data.get("status") in ("ahead", "identical") and len(files) < COMPARE_MAX_FILES:
+            return [{"path": f["filename"], "status": f["status"], "previous_path": f.get("previous_filename")}
+                    for f in files], "compare"
+        return _diff_trees(self.list_tree(owner, repo, base)[0], self.list_tree(owner, repo, head)[0]), "tree_diff"
+
+    def read_file(self, owner: str, repo: str, path: str, ref: str = None) -> bytes:
+        snapshot = _snapshot_for(owner, repo, ref)
+        if snapshot is not None:
+            data = snapshot.read(path)
+            if data is None:
+                raise FileNotFoundError(f"404 Not Found: {path}")
+            return data
+        if _blob_cache is not None:
+            sha = _blob_sha_for(owner, repo, path, ref)
+            if sha:
+                return _read_blob_cached(owner, repo, sha)
+        url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/contents/{path}"
+        headers = _get_auth_headers()
+        headers["Accept"] = "application/vnd.github.v3.raw" 
+        params = {"ref": ref} if ref else {}
+        response = _github_get(url, headers=headers, params=params)
+        response.raise_for_status()
+        return response.content
+
+    def resolve_ref(self, owner: str, repo: str, ref: str = None) -> str:
+        if ref and _SHA_RE.fullmatch(ref):
+            return ref
+        headers = dict(_get_auth_headers(), Accept="application/vnd.github.sha")
+        res = _http_request("GET", f"{GITHUB_API_URL}/repos/{owner}/{repo}/commits/{ref or 'HEAD'}", headers=headers)
+        res.raise_for_status()
+        return res.text.strip()
+
+    def list_branches(self, owner: str, repo: str, cursor: str = None, limit: int = None):
+        url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/branches"
+        branches, next_cursor = _github_get_paginated(url, cursor=cursor, limit=limit)
+        return [b['name'] for b in branches], next_cursor
+
+    def list_repos(self, owner: str) -> list:
+        """Every repository of an organization (or, failing that, a user) with the fields audits filter on."""
+        try:
+            repos, _ = _github_get_paginated(f"{GITHUB_API_URL}/orgs/{owner}/repos", params={"type": "all"})
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            repos, _ = _github_get_paginated(f"{GITHUB_API_URL}/users/{owner}/repos", params={"type": "owner"})
+        return [{"name": r["name"], "default_branch": r.get("default_branch"), "archived": r.get("archived", False),
+                 "fork": r.get("fork", False), "language": r.get("language"), "topics": r.get("topics") or [],
+                 "visibility": r.get("visibility"), "pushed_at": r.get("pushed_at")} for r in repos]
+
+    def create_branch(self, owner: str, repo: str, new_branch: str, source_branch: str) -> str:
+        headers = _get_auth_headers()
+        ref_url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/ref/heads/{source_branch}"
+        res = _http_request("GET", ref_url, headers=headers)
+        res.raise_for_status()
+        sha = res.json()["object"]["sha"]
+        
+        create_url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/refs"
+        payload = {"ref": f"refs/heads/{new_branch}", "sha": sha}
+        post_res = _http_request("POST", create_url, headers=headers, json=payload)
+        post_res.raise_for_status()
+        return sha
+
+    def delete_branch(self, owner: str, repo: str, branch: str):
+        url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/refs/heads/{branch}"
+        _http_request("DELETE", url, headers=_get_auth_headers()).raise_for_status()
+
+    def commit_file(self, owner: str, repo: str, path: str, content: str, branch: str, message: str):
+        return _rest_commit_file(owner, repo, path, content, branch, message)
+
+    def commit_files(self, owner: str, repo: str, files: list, branch: str, message: str) -> dict:
+        return _commit_files_atomic(owner, repo, files, branch, message)
+
+    def open_pull_request(self, owner: str, repo: str, title: str, head: str, base: str, body: str) -> dict:
+        url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls"
+        payload = {"title": title, "head": head, "base": base, "body": body}
+        response = _http_request("POST", url, headers=_get_auth_headers(), data=json.dumps(payload))
+        response.raise_for_status()
+        return response.json()
+
+class _LocalGitBackend:
+    """
+    Repository backend over bare repositories on disk, driven by the git CLI.
+    Pull requests have no git equivalent, so they are recorded in
+    <repo>.git/adk-pulls.json.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._pulls_lock = threading.Lock()
+
+    def _owner_dir(self, owner: str, repo: str = None) -> str:
+        """Rejects names that could step outside the root ('..', separators) before touching the disk."""
+        for kind, name in (("owner", owner), ("repository", repo)):
+            if kind == "repository" and repo is None:
+                continue
+            if not name or name in (".", "..") or any(c in name for c in "/\\\0"):
+                raise ValueError(f"Invalid {kind} name '{name}'.")
+        return os.path.join(self.root, owner)
+
+    def _inside_root(self, path: str) -> bool:
+        root = os.path.realpath(self.root)
+        return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+    def _git_dir(self, owner: str, repo: str) -> str:
+        owner_dir = self._owner_dir(owner, repo)
+        for candidate in (f"{repo}.git", repo):
+            path = os.path.join(owner_dir, candidate)
+            if os.path.isdir(path) and self._inside_root(path):
+                return path
+        raise FileNotFoundError(f"No local repository for {owner}/{repo} under {self.root}")
+
+    @staticmethod
+    def _rev(ref: str = None) -> str:
+        """A revision argument for git; refs come from callers, so one starting with '-' must not become an option."""
+        ref = ref or "HEAD"
+        if ref.startswith("-") or any(c in ref for c in "\0\n\r"):
+            raise ValueError(f"Invalid ref '{ref}'.")
+        return ref
+
+    @staticmethod
+    def _branch_ref(branch: str) -> str:
+        ref = f"refs/heads/{branch}"
+        if (not branch or branch.startswith("-")
+                or subprocess.run(["git", "check-ref-format", ref], capture_output=True).returncode != 0):
+            raise ValueError(f"Invalid branch name '{branch}'.")
+        return ref
+
+    def _git(self, owner: str, repo: str, *args, data: bytes = None, env: dict = None) -> bytes:
+        result = subprocess.run(
+            ["git", "--git-dir", self._git_dir(owner, repo), *args],
+            input=data, capture_output=True, env=env
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode("utf-8", errors="replace").strip())
+        return result.stdout
+
+    def _ls_tree(self, owner: str, repo: str, treeish: str, *flags) -> list:
+        entries = []
+        for record in self._git(owner, repo, "ls-tree", "-l", "-z", *flags, treeish).split(b"\0"):
+            if not record:
+                continue
+            meta, _, name = record.decode("utf-8", errors="replace").partition("\t")
+            mode, kind, sha, size = meta.split()
+            entries.append({"path": name, "type": kind, "sha": sha,
+                            "size": int(size) if size != "-" else 0})
+        return entries
+
+    def list_contents(self, owner: str, repo: str, path: str = "", ref: str = None):
+        path = path.strip("/")
+        treeish = f"{self._rev(ref)}:{path}"
+        try:
+            kind = self._git(owner, repo, "cat-file", "-t", treeish).decode().strip()
+        except RuntimeError:
+            raise FileNotFoundError(f"404 Not Found: {path}")
+        if kind == "blob":
+            parent = path.rpartition("/")[0]
+            return next(e for e in self.list_contents(owner, repo, parent, ref) if e["path"] == path)
+        listing = []
+        for entry in self._ls_tree(owner, repo, treeish):
+            full_path = f"{path}/{entry['path']}".strip("/")
+            listing.append({"name": entry["path"], "path": full_path, "sha": entry["sha"],
+                            "size": entry["size"], "type": "dir" if entry["type"] == "tree" else "file"})
+        return listing
+
+    def list_tree(self, owner: str, repo: str, ref: str = None, max_depth: int = None):
+        return self._ls_tree(owner, repo, self._rev(ref), "-r", "-t"), False
+
+    def changed_files(self, owner: str, repo: str, base: str, head: str):
+        out = self._git(owner, repo, "diff", "--name-status", "-z", "-M", self._rev(base), self._rev(head)).decode("utf-8", errors="replace")
+        fields = out.split("\0")
+        files, i = [], 0
+        statuses = {"A": "added", "M": "modified", "D": "removed", "R": "renamed", "T": "modified", "C": "copied"}
+        while i < len(fields) - 1:
+            code = fields[i][:1]
+            if code in ("R", "C"):
+                files.append({"path": fields[i + 2], "status": statuses[code], "previous_path": fields[i + 1]})
+                i += 3
+            else:
+                files.append({"path": fields[i + 1], "status": statuses.get(code, "modified"), "previous_path": None})
+                i += 2
+        return files, "git_diff"
+
+    def read_file(self, owner: str, repo: str, path: str, ref: str = None) -> bytes:
+        try:
+            return self._git(owner, repo, "cat-file", "blob", f"{self._rev(ref)}:{path.strip('/')}")
+        except RuntimeError:
+            raise FileNotFoundError(f"404 Not Found: {path}")
+
+    def resolve_ref(self, owner: str, repo: str, ref: str = None) -> str:
+        return self._git(owner, repo, "rev-parse", "--verify", f"{self._rev(ref)}^{{commit}}").decode().strip()
+
+    def list_branches(self, owner: str, repo: str, cursor: str = None, limit: int = None):
+        out = self._git(owner, repo, "for-each-ref", "--format=%(refname:short)", "refs/heads")
+        return _slice_listing(out.decode("utf-8").split(), cursor, limit)
+
+    def list_repos(self, owner: str) -> list:
+        owner_dir = self._owner_dir(owner)
+        if not os.path.isdir(owner_dir) or not self._inside_root(owner_dir):
+            raise FileNotFoundError(f"No local repositories for {owner} under {self.root}")
+        repos = []
+        for name in sorted(os.listdir(owner_dir)):
+            repo = name[:-4] if name.endswith(".git") else name
+            try:
+                branch = self._git(owner, repo, "symbolic-ref", "--short", "HEAD").decode().strip()
+            except (RuntimeError, FileNotFoundError):
+                continue
+            repos.append({"name": repo, "default_branch": branch, "archived": False, "fork": False,
+                          "language": None, "topics": [], "visibility": "local", "pushed_at": None})
+        return repos
+
+    def create_branch(self, owner: str, repo: str, new_branch: str, source_branch: str) -> str:
+        source = self._branch_ref(source_branch)
+        sha = self._git(owner, repo, "rev-parse", "--verify", f"{source}^{{commit}}").decode().strip()
+        # Empty old-value: fails if the branch already exists, like the REST API
+        self._git(owner, repo, "update-ref", self._branch_ref(new_branch), sha, "")
+        return sha
+
+    def delete_branch(self, owner: str, repo: str, branch: str):
+        self._git(owner, repo, "update-ref", "-d", self._branch_ref(branch))
+
+    def commit_file(self, owner: str, repo: str, path: str, content: str, branch: str, message: str):
+        return self.commit_files(owner, repo, [{"path": path, "content": content}], branch, message)
+
+    def commit_files(self, owner: str, repo: str, files: list, branch: str, message: str) -> dict:
+        contents_by_path = {}
+        for item in files:
+            contents_by_path[_normalize_readme_path(item["path"])] = item["content"]
+        branch_ref = self._branch_ref(branch)
+        head_sha = self._git(owner, repo, "rev-parse", "--verify", f"{branch_ref}^{{commit}}").decode().strip()
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, "index"))
+            env.setdefault("GIT_AUTHOR_NAME", "ADK Agent")
+            env.setdefault("GIT_AUTHOR_EMAIL", "adk-agent@localhost")
+            env.setdefault("GIT_COMMITTER_NAME", env["GIT_AUTHOR_NAME"])
+            env.setdefault("GIT_COMMITTER_EMAIL", env["GIT_AUTHOR_EMAIL"])
+            self._git(owner, repo, "read-tree", head_sha, env=env)
+            for path, content in contents_by_path.items():
+                blob = self._git(owner, repo, "hash-object", "-w", "--stdin", data=content.encode("utf-8")).decode().strip()
+                self._git(owner, repo, "update-index", "--add", "--cacheinfo", f"100644,{blob},{path}", env=env)
+            tree = self._git(owner, repo, "write-tree", env=env).decode().strip()
+            new_sha = self._git(owner, repo, "commit-tree", tree, "-p", head_sha, "-m", message, env=env).decode().strip()
+        # Compare-and-swap: refuses to move the branch if someone else already did
+        self._git(owner, repo, "update-ref", branch_ref, new_sha, head_sha)
+        return {"commit_sha": new_sha, "parent_sha": head_sha, "paths": list(contents_by_path)}
+
+    def open_pull_request(self, owner: str, repo: str, title: str, head: str, base: str, body: str) -> dict:
+        for branch in (head, base):
+            self._git(owner, repo, "rev-parse", "--verify", self._branch_ref(branch))
+        pulls_file = os.path.join(self._git_dir(owner, repo), "adk-pulls.json")
+        with self._pulls_lock:
+            pulls = []
+            if os.path.exists(pulls_file):
+                with open(pulls_file) as f:
+                    pulls = json.load(f)
+            pr = {"number": len(pulls) + 1, "title": title, "head": head, "base": base,
+                  "body": body, "html_url": None}
+            pulls.append(pr)
+            with open(pulls_file, "w") as f:
+                json.dump(pulls, f, indent=2)
+        return pr
+
+_backend = None
+
+def _get_backend():
+    """Returns the configured repository backend (REPO_BACKEND=github|local)."""
+    global _backend
+    if _backend is None:
+        if REPO_BACKEND == "local":
+            _backend = _LocalGitBackend(LOCAL_GIT_ROOT)
+        elif REPO_BACKEND == "github":
+            _backend = _GitHubRestBackend()
+        else:
+            raise ValueError(f"Unknown REPO_BACKEND '{REPO_BACKEND}' (expected 'github' or 'local').")
+    return _backend
+
+class _RefPins:
+    """
+    (partition, owner, repo, ref) -> commit SHA, pinned for one session.
+    Pins live in the shared SQLite state when RESPONSE_CACHE_PATH is set, so
+    every worker reads a run at the same commit and sees its write checks.
+    In memory, expired entries are dropped and the oldest go past _MAX_ENTRIES.
+    """
+
+    _MAX_ENTRIES = 4096
+
+    def __init__(self, ttl: float, failure_ttl: float, shared: _SharedState = None):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.shared = shared
+        self._pins = OrderedDict()
+        self._failures = OrderedDict()  # same key -> monotonic time of the last failed resolve
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        """Drops expired pins and failures, then the oldest past the cap (oldest first in both)."""
+        now, mono = time.time(), time.monotonic()
+        while self._pins and (len(self._pins) > self._MAX_ENTRIES
+                              or now - next(iter(self._pins.values()))["pinned_at"] >= self.ttl):
+            self._pins.popitem(last=False)
+        while self._failures and (len(self._failures) > self._MAX_ENTRIES
+                                  or mono - next(iter(self._failures.values())) >= self.failure_ttl):
+            self._failures.popitem(last=False)
+
+    def failed_recently(self, owner: str, repo: str, ref: str = None) -> bool:
+        with self._lock:
+            failed_at = self._failures.get((_partition(), owner, repo, ref or ""))
+        return failed_at is not None and time.monotonic() - failed_at < self.failure_ttl
+
+    def mark_failed(self, owner: str, repo: str, ref: str = None):
+        key = (_partition(), owner, repo, ref or "")
+        with self._lock:
+            self._failures[key] = time.monotonic()
+            self._failures.move_to_end(key)
+            self._prune()
+
+    def get(self, owner: str, repo: str, ref: str = None):
+        key = (_partition(), owner, repo, ref or "")
+        if self.shared is not None:
+            pin = self.shared.get_pin(json.dumps(key))
+        else:
+            with self._lock:
+                pin = self._pins.get(key)
+        if pin and time.time() - pin["pinned_at"] < self.ttl:
+            return pin["sha"]
+        return None
+
+    def set(self, owner: str, repo: str, ref: str, sha: str):
+        key = (_partition(), owner, repo, ref or "")
+        if self.shared is not None:
+            self.shared.set_pin(json.dumps(key), sha, time.time())
+        with self._lock:
+            if self.shared is None:
+                self._pins[key] = {"sha": sha, "pinned_at": time.time()}
+                self._pins.move_to_end(key)
+            self._failures.pop(key, None)
+            self._prune()
+
+    def drop(self, owner: str, repo: str, ref: str):
+        key = (_partition(), owner, repo, ref or "")
+        if self.shared is not None:
+            self.shared.drop_pin(json.dumps(key))
+        with self._lock:
+            self._pins.pop(key, None)
+
+    def resolve(self, owner: str, repo: str, ref: str = None, refresh: bool = False) -> str:
+        if ref and _SHA_RE.fullmatch(ref):
+            return ref
+        sha = None if refresh else self.get(owner, repo, ref)
+        if sha is None:
+            sha = _get_backend().resolve_ref(owner, repo, ref)
+            self.set(owner, repo, ref, sha)
+        return sha
+
+_ref_pins = _RefPins(REF_PIN_TTL_SECONDS, REF_PIN_FAILURE_TTL_SECONDS, _shared_state)
+
+def _pinned(owner: str, repo: str, ref: str = None) -> str:
+    """The commit SHA to read 'ref' at; falls back to 'ref' itself if it cannot be resolved."""
+    if not REF_PINNING or _ref_pins.failed_recently(owner, repo, ref):
+        return ref
+    try:
+        return _ref_pins.resolve(owner, repo, ref)
+    except Exception as e:
+        _ref_pins.mark_failed(owner, repo, ref)
+        print(f"WARN: Could not pin {owner}/{repo}@{ref}: {e}", file=sys.stderr)
+        return ref
+
+def _check_branch_not_stale(owner: str, repo: str, branch: str):
+    """Refuses a write if the branch moved since this session pinned it."""
+    pinned = _ref_pins.get(owner, repo, branch)
+    if pinned is None:
+        return None
+    current = _get_backend().resolve_ref(owner, repo, branch)
+    if current != pinned:
+        return (f"ERROR: Branch '{branch}' moved from {pinned[:7]} to {current[:7]} since it was pinned. "
+                f"Call pin_ref with refresh=True and re-check before writing.")
+    return None
+
+# UPDATED: Added 'ref' parameter to support branches
+def _get_contents(owner: str, repo: str, path: str = "", ref: str = None):
+    """Standard Python function to fetch repo contents."""
+    try:
+        return _get_backend().list_contents(owner, repo, path, _pinned(owner, repo, ref))
+    except Exception as e:
+        return f"ERROR: Failed to fetch contents: {str(e)}"
+
+# UPDATED: Added 'ref' parameter
+def _list_contents_logic(owner: str, repo: str, path: str = "", ref: str = None):
+    """Standard function that actually performs the API request."""
+    try:
+        return _get_backend().list_contents(owner, repo, path, _pinned(owner, repo, ref))
+    except Exception as e:
+        return f"ERROR: {e}"
+
+@mcp.tool()
+def list_branches(owner: str, repo: str, cursor: str = None, limit: int = 100) -> str:
+    """
+    Lists branches in the repository, 'limit' at a time.
+    Pass the returned 'next_cursor' back to get the next page (null when done).
+    """
+    try:
+        branches, next_cursor = _get_backend().list_branches(owner, repo, cursor=cursor, limit=limit)
+        return json.dumps({"branches": branches, "next_cursor": next_cursor})
+    except Exception as e:
+        return f"ERROR: Failed to list branches: {e}"
+
+# UPDATED: Added 'ref' support
+@mcp.tool()
+def list_repo_contents(owner: str, repo: str, path: str = "", ref: str = None,
+                       cursor: str = None, limit: int = None) -> str:
+    """
+    Lists files and folders at a path. Provide 'ref' for specific branches.
+    With 'limit' (and 'cursor' from a previous call) returns
+    {"entries": [...], "next_cursor": ...} one page at a time.
+    """
+    data = _list_contents_logic(owner, repo, path, ref=ref)
+    if isinstance(data, str): return data 
+    if (limit is not None or cursor) and isinstance(data, list):
+        entries, next_cursor = _slice_listing(data, cursor, limit)
+        return json.dumps({"entries": entries, "next_cursor": next_cursor})
+    return json.dumps(data)
+def _read_file_bytes(owner: str, repo: str, path: str, ref: str = None) -> bytes:
+    """Fetches the raw bytes of a file. Raises FileNotFoundError or HTTPError when missing."""
+    return _get_backend().read_file(owner, repo, path, _pinned(owner, repo, ref))
+
+def _read_file_logic(owner: str, repo: str, path: str, ref: str = None) -> str:
+    """The actual logic to read a file."""
+    try:
+        return _read_file_bytes(owner, repo, path, ref=ref).decode("utf-8", errors="replace")
+    except Exception as e: 
+        return f"ERROR: {e}"
+@mcp.tool()
+def read_file_content(owner: str, repo: str, path: str, ref: str = None) -> str:
+    """Tool wrapper for reading file content."""
+    return _read_file_logic(owner, repo, path, ref)
+
+_GRAPHQL_TREE_FIELDS = "... on Tree { entries { name type path object { ... on Blob { byteSize } } } }"
+_GRAPHQL_BLOB_FIELDS = "... on Blob { byteSize isBinary text }"
+
+_graphql_stats = {"queries": 0, "objects": 0, "cost": 0, "fallbacks": 0}
+_graphql_stats_lock = threading.Lock()
+
+def _graphql(query: str, variables: dict) -> dict:
+    """Runs a GraphQL query and returns its 'data'. Raises if GitHub returned no data."""
+    response = _http_request("POST", GITHUB_GRAPHQL_URL, headers=_get_auth_headers(),
+                             json={"query": query, "variables": variables})
+    response.raise_for_status()
+    payload = response.json()
+    if not payload.get("data"):
+        raise RuntimeError(f"GraphQL error: {payload.get('errors')}")
+    return payload["data"]
+
+def _graphql_objects(owner: str, repo: str, expressions: list, fields: str, batch_size: int = None) -> list:
+    """
+    Resolves many 'rev:path' expressions with aliased object() lookups,
+    batch_size per query (batches run concurrently). Returns objects in input
+    order, None where the path does not exist. If the first query costs more
+    than GRAPHQL_MAX_COST points, the remaining batches are made smaller.
+    """
+    batch_size = batch_size or GRAPHQL_BATCH_SIZE
+
+    def run_batch(batch: list) -> list:
+        var_decls = ", ".join(f"$e{i}: String!" for i in range(len(batch)))
+        selections = " ".join(f"o{i}: object(expression: $e{i}) {{ __typename {fields} }}" for i in range(len(batch)))
+        query = (f"query($owner: String!, $name: String!, {var_decls}) {{ "
+                 f"repository(owner: $owner, name: $name) {{ {selections} }} rateLimit {{ cost remaining }} }}")
+        variables = {"owner": owner, "name": repo}
+        variables.update({f"e{i}": expr for i, expr in enumerate(batch)})
+        data = _graphql(query, variables)
+        if data.get("repository") is None:
+            raise FileNotFoundError(f"Repository {owner}/{repo} not found")
+        cost = (data.get("rateLimit") or {}).get("cost", 1)
+        with _graphql_stats_lock:
+            _graphql_stats["queries"] += 1
+            _graphql_stats["objects"] += len(batch)
+            _graphql_stats["cost"] += cost
+        return [data["repository"].get(f"o{i}") for i in range(len(batch))], cost
+
+    if not expressions:
+        return []
+    # The first batch is sent alone so its cost can size the rest.
+    results, cost = run_batch(expressions[:batch_size])
+    rest = expressions[batch_size:]
+    if cost > GRAPHQL_MAX_COST:
+        batch_size = max(1, batch_size * GRAPHQL_MAX_COST // cost)
+    batches = [rest[i:i + batch_size] for i in range(0, len(rest), batch_size)]
+    for objects, _ in _run_concurrently(run_batch, batches):
+        results.extend(objects)
+    return results
+
+def _graphql_fallback(what: str, error: Exception):
+    with _graphql_stats_lock:
+        _graphql_stats["fallbacks"] += 1
+    print(f"WARN: GraphQL {what} failed, falling back to REST: {error}", file=sys.stderr)
+
+def _use_graphql(owner: str, repo: str, ref: str = None) -> bool:
+    """GraphQL only helps when reads would otherwise be individual REST calls."""
+    return (GITHUB_GRAPHQL and isinstance(_get_backend(), _GitHubRestBackend)
+            and not REPO_SNAPSHOT_MODE and _snapshots.get(owner, repo, ref) is None)
+
+def _graphql_tree_listing(tree: dict, path: str) -> list:
+    """Converts a GraphQL Tree into contents-API style entries."""
+    return [
+        {"name": e["name"], "path": f"{path}/{e['name']}".strip("/"),
+         "type": "dir" if e["type"] == "tree" else "file",
+         "size": (e.get("object") or {}).get("byteSize", 0)}
+        for e in tree.get("entries") or []
+    ]
+
+def _graphql_dir_with_readme(owner: str, repo: str, path: str = "", ref: str = None):
+    """One query for a directory listing plus the text of its most likely README names."""
+    rev = _pinned(owner, repo, ref) or "HEAD"
+    path = path.strip("/")
+    if path == ".":
+        path = ""
+    candidates = ["README.md", "README.rst", "README.txt", "README", "readme.md"]
+    expressions = [f"{rev}:{path}"] + [f"{rev}:{path}/{n}".replace(":/", ":") for n in candidates]
+    objects = _graphql_objects(owner, repo, expressions, f"{_GRAPHQL_TREE_FIELDS} {_GRAPHQL_BLOB_FIELDS}")
+    if objects[0] is None or objects[0].get("__typename") != "Tree":
+        raise FileNotFoundError(f"404 Not Found: {path}")
+    texts = {name: obj.get("text") for name, obj in zip(candidates, objects[1:]) if obj and obj.get("text") is not None}
+    return _graphql_tree_listing(objects[0], path), texts
+
+def _graphql_read_files(owner: str, repo: str, paths: list, ref: str = None) -> list:
+    """Blob bytes for each path in order; FileNotFoundError for missing paths."""
+    rev = _pinned(owner, repo, ref) or "HEAD"
+    objects = _graphql_objects(owner, repo, [f"{rev}:{p.strip('/')}" for p in paths],
+                               _GRAPHQL_BLOB_FIELDS, batch_size=GRAPHQL_BLOB_BATCH_SIZE)
+    results = []
+    for path, obj in zip(paths, objects):
+        if obj is None or obj.get("__typename") != "Blob":
+            results.append(FileNotFoundError(f"404 Not Found: {path}"))
+        elif obj.get("isBinary"):
+            results.append(b"\0")  # marker bytes so the caller's binary check skips it
+        elif obj.get("text") is None:
+            # GitHub omits text for very large blobs; read those over REST
+            results.append(_read_file_bytes(owner, repo, path, ref=ref))
+        else:
+            results.append(obj["text"].encode("utf-8"))
+    return results
+
+def _is_binary(data: bytes) -> bool:
+    """Same heuristic as git: a NUL byte near the start means binary."""
+    return b"\0" in data[:8000]
+
+def _fetch_files(owner: str, repo: str, paths: list, ref: str = None) -> list:
+    """Bytes (or the exception raised) for each path, in order: one GraphQL batch or parallel REST reads."""
+    def fetch(path: str):
+        try:
+            return _read_file_bytes(owner, repo, path, ref=ref)
+        except Exception as e:
+            return e
+
+    if _use_graphql(owner, repo, ref):
+        try:
+            return _graphql_read_files(owner, repo, paths, ref)
+        except Exception as e:
+            _graphql_fallback("batch read", e)
+    return _run_concurrently(fetch, paths)
+
+@mcp.tool()
+def read_files_batch(owner: str, repo: str, paths: list, ref: str = None,
+                     max_total_bytes: int = 200000, max_file_bytes: int = 20000) -> str:
+    """
+    Reads many files in one call. Files are fetched in parallel and returned in
+    the order given. Binaries are skipped, each file is cut at max_file_bytes and
+    the whole response at max_total_bytes; cut files are listed in 'truncated_files'.
+    """
+    fetched = _fetch_files(owner, repo, paths, ref)
+
+    files, truncated_files, skipped_binary, skipped_budget, errors = [], [], [], [], {}
+    remaining = max_total_bytes
+    for path, data in zip(paths, fetched):
+        if isinstance(data, Exception):
+            errors[path] = str(data)
+            continue
+        if _is_binary(data):
+            skipped_binary.append(path)
+            continue
+        if remaining <= 0:
+            skipped_budget.append(path)
+            continue
+        limit = min(max_file_bytes, remaining)
+        chunk = data[:limit]
+        remaining -= len(chunk)
+        truncated = len(data) > limit
+        if truncated:
+            truncated_files.append(path)
+        files.append({
+            "path": path,
+            "size": len(data),
+            "truncated": truncated,
+            "content": chunk.decode("utf-8", errors="ignore" if truncated else "replace")
+        })
+
+    return json.dumps({
+        "files": files,
+        "truncated_files": truncated_files,
+        "skipped_binary": skipped_binary,
+        "skipped_budget": skipped_budget,
+        "errors": errors,
+        "total_bytes": max_total_bytes - remaining
+    }, indent=2)
+
+# --- Code outlines ---
+_OUTLINE_DOC_CHARS = 200
+# Longer lines (minified or generated code) are skipped by the regex outlines
+_OUTLINE_MAX_LINE_CHARS = 1000
+
+_LANGUAGES = {
+    ".py": "python", ".js": "javascript", ".jsx": "javascript", ".mjs": "javascript", ".ts": "typescript",
+    ".tsx": "typescript", ".go": "go", ".java": "java", ".kt": "kotlin", ".cs": "csharp", ".rb": "ruby",
+    ".rs": "rust", ".c": "c", ".h": "c", ".cc": "cpp", ".cpp": "cpp", ".hpp": "cpp", ".php": "php",
+    ".swift": "swift", ".scala": "scala", ".sh": "shell"
+}
+
+# Line-anchored patterns for languages without a parser here. Good enough for an
+# outline; nested or multi-line declarations may be missed.
+_JS_PATTERNS = {
+    "imports": [r"^\s*import\s+(?:.+?\s+from\s+)?['\"]([^'\"]+)['\"]", r"require\(\s*['\"]([^'\"]+)['\"]\s*\)"],
+    "classes": [r"^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?(?:class|interface)\s+(\w+)"],
+    "functions": [r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(\w+\s*\([^)]*\))",
+                  r"^\s*(?:export\s+)?(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s+)?(?:\([^)]*\)|\w+)\s*=>"]
+}
+_C_LIKE_PATTERNS = {
+    "imports": [r"^\s*(?:import|using)\s+(?:static\s+)?([\w.*]+)\s*;", r"^\s*#include\s+[<\"]([^>\"]+)[>\"]"],
+    # Modifier runs are possessive and stay on one line so a long run cannot backtrack quadratically
+    "classes": [r"^[ \t]*(?:(?:public|private|protected|internal|abstract|final|static|sealed|data|open)[ \t]+)*+"
+                r"(?:class|interface|enum|struct|record|object)[ \t]+(\w+)"],
+    "functions": [r"^[ \t]*(?:(?:public|private|protected|internal|static|final|abstract|override|virtual|async|inline)[ \t]+)++"
+                  r"[\w<>\[\],.? \t]*?\b(\w+[ \t]*\([^)]*\))[ \t]*(?:throws[ \t]+[\w.]+(?:[ \t]*,[ \t]*[\w.]+)*)?"
+                  r"[ \t]*\{?[ \t]*$",
+                  r"^(?:[\w*&:<>]+[ \t]+)+\**(\w+[ \t]*\([^;{)]*\))[ \t]*\{?[ \t]*$"]
+}
+_OUTLINE_PATTERNS = {
+    "python": {  # only for files ast cannot parse
+        "imports": [r"^\s*(?:from|import)\s+([\w.]+)"],
+        "classes": [r"^\s*class\s+(\w+)"],
+        "functions": [r"^\s*(?:async\s+)?def\s+(\w+\s*\([^)]*\))"]
+    },
+    "javascript": _JS_PATTERNS, "typescript": _JS_PATTERNS,
+    "go": {
+        "imports": [r"^\s*import\s+(?:\w+\s+)?\"([^\"]+)\"", r"^\s+(?:\w+\s+)?\"([^\"]+)\"\s*$"],
+        "classes": [r"^type\s+(\w+)\s+(?:struct|interface)"],
+        "functions": [r"^func\s+((?:\([^)]*\)\s*)?\w+\s*\([^)]*\))"]
+    },
+    "rust": {
+        "imports": [r"^\s*use\s+([\w:{}, *]+);"],
+        "classes": [r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait)\s+(\w+)", r"^\s*impl(?:<[^>]*>)?\s+([\w:<> ]+?)\s*\{"],
+        "functions": [r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?fn\s+(\w+\s*(?:<[^>]*>)?\s*\([^)]*\))"]
+    },
+    "ruby": {
+        "imports": [r"^\s*require(?:_relative)?\s+['\"]([^'\"]+)['\"]"],
+        "classes": [r"^\s*(?:class|module)\s+([\w:]+)"],
+        "functions": [r"^\s*def\s+((?:self\.)?\w+[?!=]?(?:\([^)]*\))?)"]
+    },
+    "php": {
+        "imports": [r"^\s*use\s+([\w\\\\]+)", r"(?:require|include)(?:_once)?\s*\(?\s*['\"]([^'\"]+)['\"]"],
+        "classes": [r"^\s*(?:abstract\s+|final\s+)?(?:class|interface|trait)\s+(\w+)"],
+        "functions": [r"^\s*(?:(?:public|private|protected|static)\s+)*function\s+(\w+\s*\([^)]*\))"]
+    },
+    "shell": {
+        "imports": [r"^\s*(?:source|\.)\s+(\S+)"],
+        "classes": [],
+        "functions": [r"^\s*(?:function\s+)?(\w+)\s*\(\)\s*\{?"]
+    }
+}
+for _language in ("java", "kotlin", "csharp", "c", "cpp", "swift", "scala"):
+    _OUTLINE_PATTERNS[_language] = _C_LIKE_PATTERNS
+
+def _first_line(doc: str) -> str:
+    return (doc or "").strip().split("\n", 1)[0][:_OUTLINE_DOC_CHARS] or None
+
+def _python_signature(node) -> str:
+    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+    return f"{prefix} {node.name}({ast.unparse(node.args)}){returns}"
+
+def _outline_python(source: str) -> dict:
+    """Outline from the Python AST; raises SyntaxError for code that does not parse."""
+    tree = ast.parse(source)
+    imports, classes, functions = [], [], []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            prefix = "." * node.level
+            imports.extend(f"{prefix}{node.module}.{alias.name}" if node.module else f"{prefix}{alias.name}"
+                           for alias in node.names)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions.append({"signature": _python_signature(node), "doc": _first_line(ast.get_docstring(node))})
+        elif isinstance(node, ast.ClassDef):
+            classes.append({
+                "name": node.name,
+                "bases": [ast.unparse(b) for b in node.bases],
+                "doc": _first_line(ast.get_docstring(node)),
+                "methods": [{"signature": _python_signature(n), "doc": _first_line(ast.get_docstring(n))}
+                            for n in node.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+            })
+    return {"doc": _first_line(ast.get_docstring(tree)), "imports": imports, "classes": classes, "functions": functions}
+
+def _outline_by_pattern(source: str, language: str) -> dict:
+    """Regex outline for other languages: imports, type declarations and function signatures."""
+    patterns = _OUTLINE_PATTERNS.get(language, {})
+    outline = {"doc": None, "imports": [], "classes": [], "functions": []}
+    source = "\n".join(line if len(line) <= _OUTLINE_MAX_LINE_CHARS else "" for line in source.split("\n"))
+    for kind in ("imports", "classes", "functions"):
+        seen = set()
+        for pattern in patterns.get(kind, []):
+            for match in re.finditer(pattern, source, re.MULTILINE):
+                value = " ".join(match.group(1).split())
+                if value not in seen and not re.match(r"(if|for|while|switch|catch|return)\b", value):
+                    seen.add(value)
+                    outline[kind].append({"name": value} if kind == "classes" else
+                                         {"signature": value} if kind == "functions" else value)
+    return outline
+
+def _outline_file(path: str, data: bytes) -> dict:
+    source = data.decode("utf-8", errors="replace")
+    language = _LANGUAGES.get(os.path.splitext(path)[1].lower())
+    outline = None
+    if language == "python":
+        try:
+            outline = _outline_python(source)
+        except (SyntaxError, ValueError):
+            pass  # e.g. Python 2 code; the regex outline below still helps
+    if outline is None:
+        outline = _outline_by_pattern(source, language or "")
+    return dict({"path": path, "language": language, "lines": source.count("\n") + 1}, **outline)
+
+@mcp.tool()
+def summarize_directory(owner: str, repo: str, path: str = "", ref: str = None,
+                        max_files: int = 100, max_file_bytes: int = 500000) -> str:
+    """
+    Returns a compact outline of each source file in a directory (not recursive):
+    imports, classes with their methods, and functions with signatures and the
+    first line of each docstring. Python is parsed with ast; other languages
+    use a lighter pattern match. Far smaller than reading the files.
+    """
+    contents = _get_contents(owner, repo, path, ref=ref)
+    if isinstance(contents, str):
+        return contents
+    if not isinstance(contents, list):
+        return f"ERROR: '{path}' is a file, not a directory."
+
+    files = [item for item in contents if item.get("type") == "file"]
+    sources = [item["path"] for item in files
+               if os.path.splitext(item["name"])[1].lower() in _LANGUAGES and item.get("size", 0) <= max_file_bytes]
+    other_files = [item["name"] for item in files if item["path"] not in sources]
+    skipped = sources[max_files:]
+    sources = sources[:max_files]
+
+    outlines, errors = [], {}
+    for file_path, data in zip(sources, _fetch_files(owner, repo, sources, ref)):
+        if isinstance(data, Exception):
+            errors[file_path] = str(data)
+        elif not _is_binary(data):
+            outlines.append(_outline_file(file_path, data))
+
+    return json.dumps({
+        "path": path or ".",
+        "subdirectories": [item["name"] for item in contents if item.get("type") == "dir"],
+        "files": outlines,
+        "other_files": other_files,
+        "skipped_over_max_files": skipped,
+        "errors": errors
+    }, indent=2)
+
+def _module_name(path: str) -> str:
+    """'pkg/sub/mod.py' -> 'pkg.sub.mod'; a package's __init__.py is the package itself."""
+    parts = path[:-3].split("/")
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    return ".".join(parts)
+
+def _source_roots(paths) -> list:
+    """
+    Dotted names of the directories absolute imports start from, besides the repo
+    root: 'src' in src layouts and the parent of every top-level package.
+    """
+    packages = {os.path.dirname(p) for p in paths if os.path.basename(p) == "__init__.py"}
+    roots = {"src"} if any(p.startswith("src/") for p in paths) else set()
+    for package in packages:
+        while package and os.path.dirname(package) in packages:
+            package = os.path.dirname(package)
+        roots.add(os.path.dirname(package))
+    return sorted(r.replace("/", ".") for r in roots if r)
+
+def _parse_symbols(data: bytes) -> dict:
+    """Definitions (with line numbers) and raw imports of one Python blob."""
     try:
-        url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-        params = {"ref": ref} if ref else {}
-        response = requests.get(url, headers=_get_auth_headers(), params=params)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        return f"ERROR: Failed to fetch contents: {str(e)}"
+        tree = ast.parse(data.decode("utf-8", errors="replace"))
+    except (SyntaxError, ValueError):
+        return {"symbols": [], "imports": [], "error": "unparseable"}
+    symbols, imports = [], []
 
-# UPDATED: Added 'ref' parameter
-def _list_contents_logic(owner: str, repo: str, path: str = "", ref: str = None):
-    """Standard function that actually performs the API request."""
-    try:
-        url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-        params = {"ref": ref} if ref else {}
-        response = requests.get(url, headers=_get_auth_headers(), params=params)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        return f"ERROR: {e}"
+    def visit(body, scope: str):
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                symbols.append({"name": node.name, "qualname": f"{scope}{node.name}",
+                                "kind": "method" if scope else "function", "line": node.lineno,
+                                "signature": _python_signature(node), "doc": _first_line(ast.get_docstring(node))})
+            elif isinstance(node, ast.ClassDef):
+                symbols.append({"name": node.name, "qualname": f"{scope}{node.name}", "kind": "class",
+                                "line": node.lineno, "signature": f"class {node.name}"
+                                + (f"({', '.join(ast.unparse(b) for b in node.bases)})" if node.bases else ""),
+                                "doc": _first_line(ast.get_docstring(node))})
+                visit(node.body, f"{scope}{node.name}.")
+
+    visit(tree.body, "")
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.extend({"module": alias.name, "level": 0} for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            imports.append({"module": node.module or "", "level": node.level,
+                            "names": [alias.name for alias in node.names]})
+    return {"symbols": symbols, "imports": imports}
+
+class _CommitSymbols:
+    """Query structures for one commit: symbol name -> definitions, module -> imports and importers."""
+
+    def __init__(self, commit_sha: str, files: dict, parsed: dict):
+        self.commit_sha = commit_sha
+        self.modules = {_module_name(path): path for path in files}
+        self.roots = _source_roots(files)
+        self.by_name = {}
+        self.imports = {}
+        self.imported_by = {}
+        for path, blob_sha in files.items():
+            info = parsed[blob_sha]
+            module = _module_name(path)
+            for symbol in info["symbols"]:
+                entry = dict(symbol, path=path, module=module)
+                self.by_name.setdefault(symbol["name"].lower(), []).append(entry)
+                if symbol["qualname"] != symbol["name"]:
+                    self.by_name.setdefault(symbol["qualname"].lower(), []).append(entry)
+            resolved = sorted({name for imp in info["imports"] for name in self._resolve(module, path, imp)} - {""})
+            self.imports[module] = resolved
+            for target in resolved:
+                if target in self.modules:
+                    self.imported_by.setdefault(target, []).append(module)
+
+    def _resolve(self, module: str, path: str, imp: dict) -> list:
+        """
+        Absolute dotted names an import refers to. 'from pkg import a, b' yields
+        pkg.a / pkg.b where those are modules in the repo, else pkg itself.
+        """
+        name = imp["module"]
+        if imp["level"]:
+            package = module.split(".") if path.endswith("__init__.py") else module.split(".")[:-1]
+            package = package[:len(package) - (imp["level"] - 1)]
+            name = ".".join(package + ([name] if name else []))
+        # An absolute import may be relative to a source root ('from mylib import x' in src/mylib/)
+        roots = [""] + ([] if imp["level"] else self.roots)
+        for root in roots:
+            package = f"{root}.{name}".strip(".")
+            submodules = [f"{package}.{n}".strip(".") for n in imp.get("names", [])]
+            submodules = [m for m in submodules if m in self.modules]
+            if submodules:
+                return submodules
+        # 'import pkg.mod' where only pkg/mod.py exists: keep the longest prefix that is a module here.
+        # Scripts often import a neighbouring file by bare name, so try the importer's directory too,
+        # but only prefixes that include the imported name: the directory alone is not a match.
+        if path.endswith("__init__.py"):
+            directory = module
+        else:
+            directory = module.rsplit(".", 1)[0] if "." in module else ""
+        bases = roots + ([directory] if directory and not imp["level"] else [])
+        for base in bases:
+            parts = [p for p in base.split(".") if p] + name.split(".")
+            shortest = len(parts) - len(name.split(".")) + 1
+            for i in range(len(parts), shortest - 1, -1):
+                if ".".join(parts[:i]) in self.modules:
+                    return [".".join(parts[:i])]
+        return [name]
+
+class _SymbolIndex:
+    """
+    Per-(partition, owner, repo, commit) symbol tables over a shared, SHA-keyed
+    store of parsed blobs. Building a commit that shares most blobs with one
+    indexed before only fetches and parses the changed files.
+    """
+
+    def __init__(self, max_blobs: int, max_commits: int):
+        self.max_blobs = max_blobs
+        self.max_commits = max_commits
+        self._blobs = OrderedDict()    # blob SHA -> parsed symbols/imports
+        self._commits = OrderedDict()  # (partition, owner, repo, commit) -> _CommitSymbols
+        self._building = {}
+        self._lock = threading.Lock()
+        self.stats = {"commits_built": 0, "commit_hits": 0, "blobs_parsed": 0, "blobs_reused": 0}
+
+    def get(self, owner: str, repo: str, ref: str = None) -> _CommitSymbols:
+        commit_sha = _pinned(owner, repo, ref) or _get_backend().resolve_ref(owner, repo, ref)
+        if not _SHA_RE.fullmatch(commit_sha):
+            commit_sha = _get_backend().resolve_ref(owner, repo, commit_sha)
+        key = (_partition(), owner, repo, commit_sha)
+        with self._lock:
+            index = self._commits.get(key)
+            if index is not None:
+                self._commits.move_to_end(key)
+                self.stats["commit_hits"] += 1
+                return index
+            build_lock = self._building.setdefault(key, threading.Lock())
+        try:
+            with build_lock:
+                with self._lock:
+                    index = self._commits.get(key)
+                if index is None:
+                    index = self._build(owner, repo, commit_sha)
+                    with self._lock:
+                        self._commits[key] = index
+                        while len(self._commits) > self.max_commits:
+                            self._commits.popitem(last=False)
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+        return index
+
+    def _build(self, owner: str, repo: str, commit_sha: str) -> _CommitSymbols:
+        entries, _ = _get_backend().list_tree(owner, repo, commit_sha)
+        files = {e["path"]: e["sha"] for e in entries
+                 if e.get("type") == "blob" and e["path"].endswith(".py")
+                 and e.get("size", 0) <= SYMBOL_INDEX_MAX_FILE_BYTES}
+        with self._lock:
+            parsed = {sha: self._blobs[sha] for sha in set(files.values()) if sha in self._blobs}
+        missing = sorted({path for path, sha in files.items() if sha not in parsed})
+        for path, data in zip(missing, _fetch_files(owner, repo, missing, commit_sha)):
+            parsed[files[path]] = (_parse_symbols(data) if not isinstance(data, Exception)
+                                   else {"symbols": [], "imports": [], "error": str(data)})
+        with self._lock:
+            for sha in {files[p] for p in missing}:
+                self._blobs[sha] = parsed[sha]
+            for sha in parsed:
+                self._blobs.move_to_end(sha)
+            while len(self._blobs) > self.max_blobs:
+                self._blobs.popitem(last=False)
+            self.stats["commits_built"] += 1
+            self.stats["blobs_parsed"] += len(missing)
+            self.stats["blobs_reused"] += len(files) - len(missing)
+        return _CommitSymbols(commit_sha, files, parsed)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, blobs=len(self._blobs), commits=len(self._commits))
+
+_symbol_index = _SymbolIndex(SYMBOL_INDEX_MAX_BLOBS, SYMBOL_INDEX_MAX_COMMITS)
 
 @mcp.tool()
-def list_branches(owner: str, repo: str) -> str:
-    """Lists all branches in the repository."""
-    url = f"https://api.github.com/repos/{owner}/{repo}/branches"
+def find_symbol(owner: str, repo: str, name: str, ref: str = None, kind: str = None, limit: int = 50) -> str:
+    """
+    Finds where Python classes, functions or methods are defined. 'name' may be
+    a plain name ('load') or qualified ('Loader.load'); without an exact match,
+    names containing it are returned. kind: 'class', 'function' or 'method'.
+    The first call for a commit builds the index; later calls are answered from memory.
+    """
     try:
-        response = requests.get(url, headers=_get_auth_headers())
-        response.raise_for_status()
-        branches = [b['name'] for b in response.json()]
-        return json.dumps({"branches": branches})
+        index = _symbol_index.get(owner, repo, ref)
     except Exception as e:
-        return f"ERROR: Failed to list branches: {e}"
+        return f"ERROR: Failed to index symbols: {e}"
+    needle = name.lower()
+    matches = index.by_name.get(needle)
+    exact = bool(matches)
+    if not exact:
+        matches = [m for key, found in index.by_name.items() if needle in key for m in found]
+    if kind:
+        matches = [m for m in matches if m["kind"] == kind]
+    unique = list({(m["path"], m["qualname"]): m for m in matches}.values())
+    return json.dumps({
+        "commit_sha": index.commit_sha,
+        "exact": exact,
+        "matches": unique[:limit],
+        "total": len(unique)
+    }, indent=2)
 
-# UPDATED: Added 'ref' support
 @mcp.tool()
-def list_repo_contents(owner: str, repo: str, path: str = "", ref: str = None) -> str:
-    """Lists files and folders at a path. Provide 'ref' for specific branches."""
-    data = _list_contents_logic(owner, repo, path, ref=ref)
-    if isinstance(data, str): return data 
-    return json.dumps(data)
-def _read_file_logic(owner: str, repo: str, path: str, ref: str = None) -> str:
-    """The actual logic to read a file."""
+def module_imports(owner: str, repo: str, module: str, ref: str = None) -> str:
+    """
+    Dependency edges of one Python module (dotted name like 'pkg.util' or a path
+    like 'pkg/util.py'): what it imports (split into in-repo and external) and
+    which in-repo modules import it.
+    """
     try:
-        url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-        headers = _get_auth_headers()
-        headers["Accept"] = "application/vnd.github.v3.raw" 
-        params = {"ref": ref} if ref else {}
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        return response.text 
-    except Exception as e: 
-        return f"ERROR: {e}"
-@mcp.tool()
-def read_file_content(owner: str, repo: str, path: str, ref: str = None) -> str:
-    """Tool wrapper for reading file content."""
-    return _read_file_logic(owner, repo, path, ref)
+        index = _symbol_index.get(owner, repo, ref)
+    except Exception as e:
+        return f"ERROR: Failed to index symbols: {e}"
+    if module.endswith(".py"):
+        module = _module_name(module.strip("/"))
+    if module not in index.modules:
+        close = [m for m in index.modules if m.endswith(f".{module}") or m.split(".")[-1] == module]
+        if len(close) != 1:
+            return f"ERROR: Module '{module}' not found." + (f" Did you mean one of {close[:10]}?" if close else "")
+        module = close[0]
+    imports = index.imports.get(module, [])
+    return json.dumps({
+        "commit_sha": index.commit_sha,
+        "module": module,
+        "path": index.modules[module],
+        "imports": [m for m in imports if m in index.modules],
+        "external_imports": sorted({m.split(".")[0] for m in imports if m not in index.modules}),
+        "imported_by": sorted(index.imported_by.get(module, []))
+    }, indent=2)
 
 # @mcp.tool()
 # def read_file_content(owner: str, repo: str, path: str, ref: str = None) -> str:
@@ -115,14 +2193,9 @@ def read_file_content(owner: str, repo: str, path: str, ref: str = None) -> str:
 def get_project_dependencies(owner: str, repo: str, path: str = "requirements.txt", ref: str = None) -> str:
     """Retrieves dependency file content. Provide 'ref' for specific branches."""
     try:
-        url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-        headers = _get_auth_headers()
-        headers["Accept"] = "application/vnd.github.v3.raw" 
-        params = {"ref": ref} if ref else {}
-        
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        return response.text
+        return _read_file_bytes(owner, repo, path, ref=ref).decode("utf-8", errors="replace")
+    except FileNotFoundError:
+        return f"INFO: Dependency file '{path}' not found."
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 404:
             return f"INFO: Dependency file '{path}' not found."
@@ -134,8 +2207,8 @@ def get_project_dependencies(owner: str, repo: str, path: str = "requirements.tx
 def get_github_repo_info(owner: str, repo: str) -> str:
     """Retrieves metadata like stars and issues for the repository."""
     try:
-        url = f"https://api.github.com/repos/{owner}/{repo}"
-        response = requests.get(url, headers=_get_auth_headers())
+        url = f"{GITHUB_API_URL}/repos/{owner}/{repo}"
+        response = _http_request("GET", url, headers=_get_auth_headers())
         response.raise_for_status()
         data = response.json()
         info = {
@@ -153,7 +2226,14 @@ def get_github_repo_info(owner: str, repo: str) -> str:
 @mcp.tool()
 def analyze_and_suggest_readme(owner: str, repo: str, path: str = "", ref: str = None) -> str:
     """Checks for a README at a path. Use 'ref' for specific branches."""
-    contents = _get_contents(owner, repo, path, ref=ref)
+    contents, prefetched = None, {}
+    if _use_graphql(owner, repo, ref):
+        try:
+            contents, prefetched = _graphql_dir_with_readme(owner, repo, path, ref)
+        except Exception as e:
+            _graphql_fallback("directory lookup", e)
+    if contents is None:
+        contents = _get_contents(owner, repo, path, ref=ref)
     
     if isinstance(contents, str) and contents.startswith("ERROR"):
         return contents
@@ -168,7 +2248,9 @@ def analyze_and_suggest_readme(owner: str, repo: str, path: str = "", ref: str =
 
         if readme_item:
             file_path = os.path.join(path, readme_item.get("name")).replace('\\', '/')
-            existing_content = _read_file_logic(owner, repo, file_path, ref=ref)
+            existing_content = prefetched.get(readme_name)
+            if existing_content is None:
+                existing_content = _read_file_logic(owner, repo, file_path, ref=ref)
             
             return json.dumps({
                 "status": "README_EXISTS_NEEDS_ANALYSIS",
@@ -186,9 +2268,11 @@ def analyze_and_suggest_readme(owner: str, repo: str, path: str = "", ref: str =
 
 
 @mcp.tool()
-def list_repo_directories(owner: str, repo: str, path: str = "", ref: str = None) -> str:
+def list_repo_directories(owner: str, repo: str, path: str = "", ref: str = None,
+                          cursor: str = None, limit: int = None) -> str:
     """
     Lists subdirectories and explicitly includes the Root (.) as an option.
+    Use 'limit'/'cursor' to page through very large directories.
     """
     contents = _get_contents(owner, repo, path, ref=ref)
     
@@ -204,18 +2288,228 @@ def list_repo_directories(owner: str, repo: str, path: str = "", ref: str = None
         if path == "" or path == ".":
             display_list = ["Root (.)"] + directories
 
+        display_list, next_cursor = _slice_listing(display_list, cursor, limit)
         return json.dumps({
             "parent_path": path or "root",
-            "available_targets": display_list
+            "available_targets": display_list,
+            "next_cursor": next_cursor
         }, indent=2)
     except Exception as e:
         return f"ERROR: {e}"
 
+def _get_tree(owner: str, repo: str, tree_ref: str, recursive: bool = True) -> dict:
+    """Fetches a git tree (by SHA, branch or 'HEAD') through the Trees API."""
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees/{tree_ref}"
+    params = {"recursive": "1"} if recursive else {}
+    response = _github_get(url, headers=_get_auth_headers(), params=params)
+    response.raise_for_status()
+    return response.json()
+
+def _list_tree_entries(owner: str, repo: str, ref: str = None, max_depth: int = None):
+    """
+    Returns (entries, truncated_fallback) for every blob/tree under 'ref' with full paths.
+    One recursive call covers most repos; if GitHub truncates the listing we
+    walk level by level and retry each subtree recursively.
+    """
+    entries = []
+    used_fallback = False
+
+    def walk(tree_ref: str, prefix: str, depth: int):
+        nonlocal used_fallback
+        data = _get_tree(owner, repo, tree_ref, recursive=True)
+        if not data.get("truncated"):
+            for item in data.get("tree", []):
+                entries.append(dict(item, path=f"{prefix}/{item['path']}".strip("/")))
+            return
+        used_fallback = True
+        level = _get_tree(owner, repo, tree_ref, recursive=False)
+        for item in level.get("tree", []):
+            full_path = f"{prefix}/{item['path']}".strip("/")
+            entries.append(dict(item, path=full_path))
+            if item.get("type") == "tree" and (max_depth is None or depth < max_depth):
+                walk(item["sha"], full_path, depth + 1)
+
+    walk(ref or "HEAD", "", 0)
+    return entries, used_fallback
+
+def _readme_targets_from_tree(entries: list, base_path: str = "", include_paths: list = None,
+                              max_depth: int = None, include_globs: list = None,
+                              exclude_globs: list = None) -> list:
+    """Computes, in memory, every directory that has files but no README."""
+    base = base_path.strip("/")
+    dirs = {}
+    for item in entries:
+        if item.get("type") == "tree":
+            dirs.setdefault(item["path"], {"has_readme": False, "has_code": False})
+        elif item.get("type") == "blob":
+            parent, _, name = item["path"].rpartition("/")
+            info = dirs.setdefault(parent, {"has_readme": False, "has_code": False})
+            if name.lower().startswith("readme"):
+                info["has_readme"] = True
+            else:
+                info["has_code"] = True
+
+    roots = None
+    check_root = False
+    if include_paths:
+        check_root = "." in include_paths or "Root (.)" in include_paths
+        roots = [f"{base}/{p}".strip("/") for p in include_paths if p not in [".", "Root (.)"]]
+
+    targets = []
+    for path in sorted(dirs):
+        info = dirs[path]
+        if not info["has_code"] or info["has_readme"]:
+            continue
+        if path == "":
+            if check_root:
+                targets.append(".")
+            continue
+        if base and not path.startswith(base + "/"):
+            continue
+        if roots is not None and not any(path == r or path.startswith(r + "/") for r in roots):
+            continue
+        relative_depth = path[len(base):].strip("/").count("/") + 1
+        if max_depth is not None and relative_depth > max_depth:
+            continue
+        if include_globs and not any(fnmatch.fnmatch(path, g) for g in include_globs):
+            continue
+        if exclude_globs and any(fnmatch.fnmatch(path, g) for g in exclude_globs):
+            continue
+        targets.append(path)
+    return targets
+
+def _diff_trees(base_entries: list, head_entries: list) -> list:
+    """Changed blobs between two recursive tree listings, compared by SHA."""
+    base = {e["path"]: e["sha"] for e in base_entries if e.get("type") == "blob"}
+    head = {e["path"]: e["sha"] for e in head_entries if e.get("type") == "blob"}
+    changed = []
+    for path in sorted(base.keys() | head.keys()):
+        if path not in base:
+            changed.append({"path": path, "status": "added", "previous_path": None})
+        elif path not in head:
+            changed.append({"path": path, "status": "removed", "previous_path": None})
+        elif base[path] != head[path]:
+            changed.append({"path": path, "status": "modified", "previous_path": None})
+    return changed
+
+@mcp.tool()
+def find_changed_directories(owner: str, repo: str, base_sha: str, ref: str = None, base_path: str = "",
+                             include_paths: list = None, ignore_readmes: bool = True) -> str:
+    """
+    For reruns: lists only the directories whose files changed between base_sha
+    (the last documented commit) and 'ref', with the changed files in each.
+    A renamed file counts for both its old and new directory. README edits are
+    ignored by default so the previous documentation commit does not count as a
+    change. include_paths limits the result to those directories ('.' is the root).
+    """
+    try:
+        base = _get_backend().resolve_ref(owner, repo, base_sha)
+        head = _pinned(owner, repo, ref)
+        if not head or not _SHA_RE.fullmatch(head):
+            head = _get_backend().resolve_ref(owner, repo, head)
+        files, method = _get_backend().changed_files(owner, repo, base, head)
+    except Exception as e:
+        return f"ERROR: Failed to compare {base_sha}...{ref or 'HEAD'}: {e}"
+
+    prefix = base_path.strip("/")
+    wanted = None
+    if include_paths is not None:
+        wanted = {"." if p in (".", "Root (.)") else f"{prefix}/{p.strip('/')}".strip("/") for p in include_paths}
+
+    directories = {}
+    for change in files:
+        if ignore_readmes and os.path.basename(change["path"]).lower().startswith("readme"):
+            continue
+        # A rename within one directory lists the file there once
+        for directory in {os.path.dirname(p) or "." for p in (change["path"], change.get("previous_path")) if p}:
+            if prefix and not (directory == prefix or directory.startswith(f"{prefix}/")):
+                continue
+            if wanted is not None and directory not in wanted:
+                continue
+            directories.setdefault(directory, []).append(
+                {k: v for k, v in change.items() if v is not None})
+
+    return json.dumps({
+        "base_sha": base,
+        "head_sha": head,
+        "method": method,
+        "changed_directories": [{"path": d, "files": directories[d]} for d in sorted(directories)],
+        "changed_files": len(files)
+    }, indent=2)
+
+def _find_readme_targets_tree(owner: str, repo: str, base_path: str = "", include_paths: list = None,
+                              ref: str = None, max_depth: int = None, include_globs: list = None,
+                              exclude_globs: list = None) -> str:
+    """Tree-mode scan: one Trees API call for the whole ref instead of one per directory."""
+    try:
+        entries, used_fallback = _get_backend().list_tree(owner, repo, _pinned(owner, repo, ref), max_depth=None if base_path.strip("/") else max_depth)
+        targets = _readme_targets_from_tree(entries, base_path, include_paths, max_depth,
+                                            include_globs, exclude_globs)
+        return json.dumps({
+            "scan_mode": "tree",
+            "targets_identified": targets,
+            "truncated_fallback": used_fallback
+        })
+    except Exception as e:
+        return f"ERROR: Tree scan failed: {e}"
+
+def _find_readme_targets_graphql(owner: str, repo: str, base_path: str = "", include_paths: list = None,
+                                 ref: str = None) -> str:
+    """GraphQL-mode scan: directory listings are packed into a few batched queries."""
+    rev = _pinned(owner, repo, ref) or "HEAD"
+    base = base_path.strip("/")
+    check_root = False
+    if include_paths:
+        check_root = "." in include_paths or "Root (.)" in include_paths
+        paths = [f"{base}/{p}".strip("/") for p in include_paths if p not in [".", "Root (.)"]]
+    else:
+        root = _graphql_objects(owner, repo, [f"{rev}:{base}"], _GRAPHQL_TREE_FIELDS)[0]
+        if root is None:
+            raise FileNotFoundError(f"404 Not Found: {base}")
+        paths = [e["path"] for e in _graphql_tree_listing(root, base) if e["type"] == "dir"]
+
+    expressions = ([f"{rev}:"] if check_root else []) + [f"{rev}:{p}" for p in paths]
+    trees = _graphql_objects(owner, repo, expressions, _GRAPHQL_TREE_FIELDS)
+
+    targets = []
+    for path, tree in zip((["."] if check_root else []) + paths, trees):
+        if tree is None or tree.get("__typename") != "Tree":
+            continue
+        listing = _graphql_tree_listing(tree, "" if path == "." else path)
+        has_readme = any(i["name"].lower().startswith("readme") for i in listing)
+        has_code = any(i["type"] == "file" for i in listing)
+        if has_code and not has_readme:
+            targets.append(path)
+    return json.dumps({"scan_mode": "graphql", "targets_identified": targets})
+
 @mcp.tool()
-def find_readme_targets(owner: str, repo: str, base_path: str = "", include_paths: list = None, ref: str = None) -> str:
+def find_readme_targets(owner: str, repo: str, base_path: str = "", include_paths: list = None, ref: str = None,
+                        scan_mode: str = "contents", max_depth: int = None,
+                        include_globs: list = None, exclude_globs: list = None, max_workers: int = None) -> str:
     """
     Scans for missing READMEs. Handles '.' as a request to scan the root.
+    scan_mode="tree" fetches the whole tree for 'ref' in one call and finds nested
+    directories at any depth (limit with max_depth, filter with include/exclude globs).
+    In contents mode, max_workers caps the parallel per-directory requests.
+    scan_mode="graphql" checks the same directories with a few batched GraphQL queries.
+    For large repos use start_scan instead, which runs the same scan in the background.
     """
+    return _scan_readme_targets(owner, repo, base_path, include_paths, ref, scan_mode, max_depth,
+                                include_globs, exclude_globs, max_workers)
+
+def _scan_readme_targets(owner: str, repo: str, base_path: str = "", include_paths: list = None, ref: str = None,
+                         scan_mode: str = "contents", max_depth: int = None, include_globs: list = None,
+                         exclude_globs: list = None, max_workers: int = None, progress=None) -> str:
+    """find_readme_targets itself; progress(done, total) is called as contents-mode directories finish."""
+    if scan_mode == "tree":
+        return _find_readme_targets_tree(owner, repo, base_path, include_paths, ref,
+                                         max_depth, include_globs, exclude_globs)
+    if scan_mode == "graphql" and isinstance(_get_backend(), _GitHubRestBackend):
+        try:
+            return _find_readme_targets_graphql(owner, repo, base_path, include_paths, ref)
+        except Exception as e:
+            _graphql_fallback("scan", e)
+
     targets = []
     
     # 1. If include_paths is provided, check if Root is requested
@@ -233,33 +2527,366 @@ def find_readme_targets(owner: str, repo: str, base_path: str = "", include_path
         contents = _get_contents(owner, repo, base_path, ref=ref)
         dirs_to_check = [item['name'] for item in contents if item.get("type") == "dir"]
 
-    # 2. Scan the subdirectories
-    for subdir in dirs_to_check:
-        path = f"{base_path}/{subdir}".strip("/")
+    # 2. Scan the subdirectories (fetched in parallel, results in input order)
+    paths = [f"{base_path}/{subdir}".strip("/") for subdir in dirs_to_check]
+    done = 0
+    done_lock = threading.Lock()
+
+    def needs_readme(path: str) -> bool:
+        nonlocal done
         subdir_contents = _get_contents(owner, repo, path, ref=ref)
-        if isinstance(subdir_contents, str): continue
-        
+        if progress is not None:
+            with done_lock:
+                done += 1
+                progress(done, len(paths))
+        if isinstance(subdir_contents, str): return False
+
         has_readme = any(i.get("name", "").lower().startswith("readme") for i in subdir_contents)
         has_code = any(i.get("type") == "file" for i in subdir_contents)
-        if has_code and not has_readme:
+        return has_code and not has_readme
+
+    for path, is_target in zip(paths, _run_concurrently(needs_readme, paths, max_workers)):
+        if is_target:
             targets.append(path)
 
     return json.dumps({"targets_identified": targets})
 
+class _ScanJobs:
+    """
+    Background README scans on a small worker pool. Jobs and cached results are
+    scoped to the caller's partition; results are keyed by the commit SHA, so
+    a cached result is exactly what a new scan would find. With a shared store,
+    job state and results are written through to SQLite so a poll can land on
+    any worker process.
+    """
+
+    def __init__(self, workers: int, ttl: float, stale_after: float, shared: _SharedState = None):
+        self.workers = workers
+        self.ttl = ttl
+        self.stale_after = stale_after
+        self.shared = shared
+        self._executor = None
+        self._jobs = {}
+        self._results = {}   # (partition, owner, repo, commit, params) -> (result, finished_at)
+        self._running = {}   # same key -> job id, so identical scans are not started twice
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "cached": 0, "joined": 0, "failed": 0}
+
+    def _evict(self, now: float):
+        for key in [k for k, (_, finished) in self._results.items() if now - finished > self.ttl]:
+            del self._results[key]
+        for job_id in [j for j, job in self._jobs.items()
+                       if job["finished_at"] and now - job["finished_at"] > self.ttl]:
+            del self._jobs[job_id]
+        if self.shared is not None:
+            self.shared.expire_scans(now - self.ttl)
+
+    def _save(self, job: dict):
+        if self.shared is not None:
+            self.shared.put_job(job["scan_key"], job)
+
+    def start(self, owner: str, repo: str, ref: str, params: dict) -> dict:
+        # Results are cached by commit, so a branch name must never become the key
+        commit = _pinned(owner, repo, ref)
+        if not commit or not _SHA_RE.fullmatch(commit):
+            commit = _get_backend().resolve_ref(owner, repo, commit)
+        key = (_partition(), owner, repo, commit, json.dumps(params, sort_keys=True))
+        scan_key = json.dumps(key)
+        now = time.time()
+        job = {"job_id": uuid.uuid4().hex, "partition": key[0], "scan_key": scan_key, "repo": f"{owner}/{repo}",
+               "ref": ref, "commit_sha": commit, "status": "queued", "cached": False,
+               "progress": {"done": 0, "total": None}, "started_at": now, "finished_at": None,
+               "result": None, "error": None}
+        with self._lock:
+            self._evict(now)
+            cached = self._results[key][0] if key in self._results else None
+            if cached is None and self.shared is not None:
+                cached = self.shared.get_scan_result(scan_key, now - self.ttl)
+            active = None
+            if cached is None and key in self._running:
+                active = self._jobs[self._running[key]]
+            elif cached is None and self.shared is not None:
+                active = self.shared.active_job(scan_key, now - self.stale_after)
+            if cached is not None:
+                job.update(status="done", cached=True, result=cached, finished_at=now)
+                self.stats["cached"] += 1
+            elif active is not None:
+                self.stats["joined"] += 1
+                return active
+            else:
+                self._running[key] = job["job_id"]
+                self.stats["started"] += 1
+            self._jobs[job["job_id"]] = job
+            self._save(job)
+            if job["status"] == "queued":
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scan-job")
+                # The caller's token (and trace) must follow the job onto the worker thread
+                self._executor.submit(contextvars.copy_context().run, self._run, job, key, owner, repo, commit, params)
+        return job
+
+    def _run(self, job: dict, key, owner: str, repo: str, commit: str, params: dict):
+        job["status"] = "running"
+        self._save(job)
+        last_saved = time.monotonic()
+
+        def progress(done: int, total: int):
+            nonlocal last_saved
+            job["progress"] = {"done": done, "total": total}
+            # Other workers only need coarse progress; also serves as the job's heartbeat
+            if self.shared is not None and time.monotonic() - last_saved >= 1.0:
+                self._save(job)
+                last_saved = time.monotonic()
+
+        try:
+            result = _scan_readme_targets(owner, repo, ref=commit, progress=progress, **params)
+            if result.startswith("ERROR"):
+                raise RuntimeError(result)
+            result = json.loads(result)
+            finished_at = time.time()
+            with self._lock:
+                self._results[key] = (result, finished_at)
+            if self.shared is not None:
+                self.shared.put_scan_result(job["scan_key"], result, finished_at)
+            job.update(status="done", result=result)
+        except Exception as e:
+            job.update(status="failed", error=str(e))
+            with self._lock:
+                self.stats["failed"] += 1
+        finally:
+            job["finished_at"] = time.time()
+            self._save(job)
+            with self._lock:
+                self._running.pop(key, None)
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.shared is not None:
+            stored = self.shared.get_job(job_id)
+            if stored is not None:
+                job, updated_at = stored
+                if job["status"] in ("queued", "running") and time.time() - updated_at > self.stale_after:
+                    job.update(status="failed", error="The worker running this scan stopped reporting; start it again.")
+        return job if job is not None and job["partition"] == _partition() else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, jobs=len(self._jobs), running=len(self._running),
+                        cached_results=len(self._results), shared=self.shared is not None)
+
+_scan_jobs = _ScanJobs(SCAN_JOB_WORKERS, SCAN_RESULT_TTL_SECONDS, SCAN_JOB_STALE_SECONDS, _shared_state)
+
+def _job_status(job: dict) -> dict:
+    elapsed = (job["finished_at"] or time.time()) - job["started_at"]
+    status = {k: job[k] for k in ("job_id", "repo", "ref", "commit_sha", "status", "cached", "progress", "error")}
+    return dict(status, elapsed_seconds=round(elapsed, 2))
+
+@mcp.tool()
+def start_scan(owner: str, repo: str, base_path: str = "", include_paths: list = None, ref: str = None,
+               scan_mode: str = "contents", max_depth: int = None,
+               include_globs: list = None, exclude_globs: list = None) -> str:
+    """
+    Starts find_readme_targets in the background and returns a job_id at once.
+    Poll with get_scan_status (wait_seconds streams progress), then fetch the
+    targets with get_scan_result. A finished scan of the same commit and
+    arguments is returned from cache.
+    """
+    params = {"base_path": base_path, "include_paths": include_paths, "scan_mode": scan_mode,
+              "max_depth": max_depth, "include_globs": include_globs, "exclude_globs": exclude_globs}
+    try:
+        job = _scan_jobs.start(owner, repo, ref, params)
+    except Exception as e:
+        return f"ERROR: Failed to start scan: {e}"
+    return json.dumps(_job_status(job), indent=2)
+
+@mcp.tool()
+async def get_scan_status(job_id: str, wait_seconds: float = 0, ctx: Context = None) -> str:
+    """
+    Returns a scan job's status and progress. With wait_seconds (max 240) it waits
+    for the job to finish, sending progress notifications meanwhile.
+    """
+    job = _scan_jobs.get(job_id)
+    if job is None:
+        return f"ERROR: Unknown scan job '{job_id}'."
+    deadline = time.monotonic() + min(max(wait_seconds, 0), 240)
+    reported = None
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        current = (job["progress"]["done"], job["progress"]["total"])
+        if ctx is not None and current != reported:
+            await ctx.report_progress(progress=current[0], total=current[1], message=f"Scanning {job['repo']}")
+            reported = current
+        await asyncio.sleep(0.5)
+        # Re-read: the job may be running on another worker process
+        job = _scan_jobs.get(job_id) or job
+    return json.dumps(_job_status(job), indent=2)
+
+@mcp.tool()
+def get_scan_result(job_id: str) -> str:
+    """Returns the targets found by a finished scan job (same shape as find_readme_targets)."""
+    job = _scan_jobs.get(job_id)
+    if job is None:
+        return f"ERROR: Unknown scan job '{job_id}'."
+    if job["status"] == "failed":
+        return f"ERROR: Scan failed: {job['error']}"
+    if job["status"] != "done":
+        return f"INFO: Scan is still {job['status']} ({job['progress']['done']}/{job['progress']['total'] or '?'} directories). Call get_scan_status with wait_seconds."
+    return json.dumps(dict(job["result"], job_id=job_id, commit_sha=job["commit_sha"], cached=job["cached"]), indent=2)
+
+def _repo_matches(repo: dict, filters: dict) -> bool:
+    """Applies audit_org_readmes filters to one repository record."""
+    if not filters.get("include_archived") and repo["archived"]:
+        return False
+    if not filters.get("include_forks") and repo["fork"]:
+        return False
+    if filters.get("name_globs") and not any(fnmatch.fnmatch(repo["name"], g) for g in filters["name_globs"]):
+        return False
+    if any(fnmatch.fnmatch(repo["name"], g) for g in filters.get("exclude_globs") or []):
+        return False
+    if filters.get("languages") and (repo["language"] or "").lower() not in {l.lower() for l in filters["languages"]}:
+        return False
+    if filters.get("topics") and not set(filters["topics"]) & set(repo["topics"]):
+        return False
+    if filters.get("visibility") and repo["visibility"] != filters["visibility"]:
+        return False
+    if filters.get("pushed_after") and (repo["pushed_at"] or "") < filters["pushed_after"]:
+        return False
+    return True
+
+class _AuditCheckpoints:
+    """JSON checkpoint per audit in ORG_AUDIT_CHECKPOINT_DIR, rewritten atomically after each repo."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, checkpoint_id: str) -> str:
+        if not re.fullmatch(r"[0-9a-f]{32}", checkpoint_id or ""):
+            raise ValueError(f"Invalid checkpoint id '{checkpoint_id}'.")
+        return os.path.join(self.directory, f"{checkpoint_id}.json")
+
+    def load(self, checkpoint_id: str) -> dict:
+        with open(self._path(checkpoint_id), encoding="utf-8") as f:
+            state = json.load(f)
+        if state["partition"] != _partition():
+            raise PermissionError("Checkpoint belongs to a different GitHub identity.")
+        return state
+
+    def save(self, state: dict):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(state["checkpoint_id"])
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+
+_audit_checkpoints = _AuditCheckpoints(ORG_AUDIT_CHECKPOINT_DIR)
+
+@mcp.tool()
+def audit_org_readmes(org: str, filters: dict = None, checkpoint_id: str = None, max_repos: int = 50,
+                      time_budget_seconds: float = 240, max_workers: int = None) -> str:
+    """
+    Runs the README-target scan (tree mode) over an organization's repositories
+    on their default branches and returns one compact line per repo.
+    filters: name_globs, exclude_globs, languages, topics, visibility,
+    pushed_after (ISO date), include_archived, include_forks.
+    Each call scans up to max_repos repos within time_budget_seconds and stops
+    early if the rate-limit budget runs low; pass the returned checkpoint_id
+    (and no filters, or the same ones) to continue. Repos that failed are
+    retried on later calls. The report covers every repo scanned so far.
+    """
+    try:
+        if checkpoint_id:
+            state = _audit_checkpoints.load(checkpoint_id)
+            if state["org"] != org:
+                return f"ERROR: Checkpoint {checkpoint_id} is for '{state['org']}', not '{org}'."
+            if filters is not None and filters != state["filters"]:
+                return (f"ERROR: Checkpoint {checkpoint_id} was started with filters {json.dumps(state['filters'])}. "
+                        "Resume without filters, or start a new audit to use different ones.")
+        else:
+            filters = filters or {}
+            repos = [r for r in _get_backend().list_repos(org) if _repo_matches(r, filters)]
+            state = {"checkpoint_id": uuid.uuid4().hex, "partition": _partition(), "org": org, "filters": filters,
+                     "repos": [{"name": r["name"], "branch": r["default_branch"]} for r in repos], "results": {}}
+            _audit_checkpoints.save(state)
+    except Exception as e:
+        return f"ERROR: Failed to start audit of '{org}': {e}"
+
+    def needs_scan(name: str) -> bool:
+        result = state["results"].get(name)
+        return result is None or (result["status"] == "error"
+                                  and result.get("attempts", 1) < ORG_AUDIT_MAX_ATTEMPTS)
+
+    unscanned = [r for r in state["repos"] if needs_scan(r["name"])]
+    pending = unscanned[:max(0, max_repos)]
+    deadline = time.monotonic() + time_budget_seconds
+    token_key = _partition()
+    stop_reason = None
+    state_lock = threading.Lock()
+
+    def audit(repo: dict):
+        nonlocal stop_reason
+        if time.monotonic() > deadline:
+            stop_reason = stop_reason or "time_budget"
+            return
+        remaining = _rate_limiter.remaining(token_key)
+        if remaining is not None and remaining < ORG_AUDIT_BUDGET_RESERVE:
+            stop_reason = "rate_limit_reserve"
+            return
+        try:
+            ref = repo["branch"]
+            if not ref:
+                raise ValueError("repository is empty")
+            commit = _pinned(org, repo["name"], ref) or ref
+            scan = _scan_readme_targets(org, repo["name"], ref=commit, scan_mode="tree")
+            if scan.startswith("ERROR"):
+                raise RuntimeError(scan)
+            targets = json.loads(scan)["targets_identified"]
+            result = {"status": "ok", "branch": ref, "commit_sha": commit, "targets": len(targets),
+                      "target_paths": targets[:10]}
+        except Exception as e:
+            result = {"status": "error", "branch": repo["branch"], "error": str(e)[:200]}
+        with state_lock:
+            previous = state["results"].get(repo["name"])
+            if result["status"] == "error":
+                result["attempts"] = (previous.get("attempts", 1) if previous else 0) + 1
+            state["results"][repo["name"]] = result
+            _audit_checkpoints.save(state)
+
+    _run_concurrently(audit, pending, max_workers or ORG_AUDIT_MAX_WORKERS)
+    if stop_reason is None and len(pending) < len(unscanned):
+        stop_reason = "max_repos"
+
+    results = state["results"]
+    remaining_repos = sum(1 for r in state["repos"] if needs_scan(r["name"]))
+    if stop_reason is None and remaining_repos:
+        stop_reason = "retry_failed"  # every repo was tried; the failed ones go again next call
+    report = [dict(repo=name, **result) for name, result in sorted(results.items())]
+    return json.dumps({
+        "org": org,
+        "checkpoint_id": state["checkpoint_id"],
+        "filters": state["filters"],
+        "complete": remaining_repos == 0,
+        "stopped_because": stop_reason if remaining_repos else None,
+        "repos_total": len(state["repos"]),
+        "repos_scanned": len(results),
+        "repos_remaining": remaining_repos,
+        "summary": {
+            "repos_needing_readmes": sum(1 for r in results.values() if r.get("targets")),
+            "total_targets": sum(r.get("targets", 0) for r in results.values()),
+            "errors": sum(1 for r in results.values() if r["status"] == "error")
+        },
+        "report": report
+    }, indent=2)
+
 @mcp.tool()
 def create_branch(owner: str, repo: str, new_branch: str, source_branch: str = "main") -> str:
     """Creates a new branch from a source branch."""
-    headers = _get_auth_headers()
-    ref_url = f"https://api.github.com/repos/{owner}/{repo}/git/ref/heads/{source_branch}"
     try:
-        res = requests.get(ref_url, headers=headers)
-        res.raise_for_status()
-        sha = res.json()["object"]["sha"]
-        
-        create_url = f"https://api.github.com/repos/{owner}/{repo}/git/refs"
-        payload = {"ref": f"refs/heads/{new_branch}", "sha": sha}
-        post_res = requests.post(create_url, headers=headers, json=payload)
-        post_res.raise_for_status()
+        sha = _get_backend().create_branch(owner, repo, new_branch, source_branch)
+        _ref_pins.set(owner, repo, new_branch, sha)
+        _invalidate_repo_cache(owner, repo)
         return f"SUCCESS: Branch '{new_branch}' created from '{source_branch}'."
     except Exception as e:
         return f"ERROR: Failed to create branch: {e}"
@@ -291,33 +2918,53 @@ def create_branch(owner: str, repo: str, new_branch: str, source_branch: str = "
 #         return f"SUCCESS: Committed to {branch}."
 #     except Exception as e:
 #         return f"ERROR: Commit failed: {e}"
-@mcp.tool()
-def commit_file_to_github(owner: str, repo: str, path: str, content: str, branch: str, commit_message: str = "docs: update repository documentation") -> str:
-    """
-    Commits a file to a specific branch. 
-    Smart path handling to prevent README.md/README.md errors.
-    """
-    headers = _get_auth_headers()
-    
-    # 1. SMART PATH NORMALIZATION
+def _normalize_readme_path(path: str) -> str:
+    """SMART PATH NORMALIZATION: maps a target directory (or README path) to its README.md."""
     clean_path = path.strip("/")
     
     # If path is root markers, target is top-level README
     if clean_path in [".", "", "Root (.)"]:
-        target_path = "README.md"
+        return "README.md"
     # If the agent already included 'README.md' in the path, don't double it
     elif clean_path.lower().endswith("readme.md"):
-        target_path = clean_path
+        return clean_path
     # Otherwise, assume it's a directory and append README.md
     else:
-        target_path = f"{clean_path}/README.md"
+        return f"{clean_path}/README.md"
+
+@mcp.tool()
+def commit_file_to_github(owner: str, repo: str, path: str, content: str, branch: str, commit_message: str = "docs: update repository documentation") -> str:
+    """
+    Commits a file to a specific branch. 
+    Smart path handling to prevent README.md/README.md errors.
+    """
+    # 1. SMART PATH NORMALIZATION
+    target_path = _normalize_readme_path(path)
+
+    try:
+        stale = _check_branch_not_stale(owner, repo, branch)
+        if stale:
+            return stale
+        result = _get_backend().commit_file(owner, repo, target_path, content, branch, commit_message)
+        new_sha = (result.get("commit") or {}).get("sha") or result.get("commit_sha")
+        if new_sha:
+            _ref_pins.set(owner, repo, branch, new_sha)
+        _invalidate_repo_cache(owner, repo)
+        return f"SUCCESS: Committed to {target_path} on branch {branch}."
+    except requests.exceptions.HTTPError as e:
+        return f"ERROR: Commit failed for {target_path}: {e.response.text}"
+    except Exception as e:
+        return f"ERROR: Commit failed for {target_path}: {str(e)}"
 
-    url = f"https://api.github.com/repos/{owner}/{repo}/contents/{target_path}"
+def _rest_commit_file(owner: str, repo: str, target_path: str, content: str, branch: str, commit_message: str):
+    """Single-file commit through the contents API (GET existing SHA, then PUT)."""
+    headers = _get_auth_headers()
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/contents/{target_path}"
     
     # 2. Check for existing file SHA on the SPECIFIC branch
     sha = None
     try:
-        check_res = requests.get(url, headers=headers, params={"ref": branch})
+        check_res = _http_request("GET", url, headers=headers, params={"ref": branch})
         if check_res.status_code == 200:
             sha = check_res.json().get("sha")
     except:
@@ -334,23 +2981,84 @@ def commit_file_to_github(owner: str, repo: str, path: str, content: str, branch
         payload["sha"] = sha
 
     # 4. Execute
+    response = _http_request("PUT", url, headers=headers, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+def _commit_files_atomic(owner: str, repo: str, files: list, branch: str, commit_message: str) -> dict:
+    """
+    Writes all files in a single commit with the Git Data API:
+    read ref -> read commit -> create tree -> create commit -> move ref.
+    File contents go inline in the tree request, so no per-file blob calls are needed.
+    """
+    headers = _get_auth_headers()
+    base = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git"
+
+    # Last write wins if the agent sends the same target twice
+    contents_by_path = {}
+    for item in files:
+        contents_by_path[_normalize_readme_path(item["path"])] = item["content"]
+    tree_entries = [
+        {"path": p, "mode": "100644", "type": "blob", "content": c}
+        for p, c in contents_by_path.items()
+    ]
+
+    # Retry once if another writer moves the branch between read and update
+    for attempt in range(2):
+        ref_res = _github_get(f"{base}/ref/heads/{branch}", headers=headers, use_cache=False)
+        ref_res.raise_for_status()
+        head_sha = ref_res.json()["object"]["sha"]
+
+        commit_res = _github_get(f"{base}/commits/{head_sha}", headers=headers)
+        commit_res.raise_for_status()
+        base_tree = commit_res.json()["tree"]["sha"]
+
+        tree_res = _http_request("POST", f"{base}/trees", headers=headers,
+                                 json={"base_tree": base_tree, "tree": tree_entries})
+        tree_res.raise_for_status()
+
+        new_commit = _http_request("POST", f"{base}/commits", headers=headers, json={
+            "message": commit_message,
+            "tree": tree_res.json()["sha"],
+            "parents": [head_sha]
+        })
+        new_commit.raise_for_status()
+        new_sha = new_commit.json()["sha"]
+
+        update = _http_request("PATCH", f"{base}/refs/heads/{branch}", headers=headers,
+                               json={"sha": new_sha, "force": False})
+        if update.status_code == 422 and attempt == 0:
+            continue
+        update.raise_for_status()
+        return {"commit_sha": new_sha, "parent_sha": head_sha, "paths": list(contents_by_path)}
+
+@mcp.tool()
+def commit_files_to_github(owner: str, repo: str, files: list, branch: str, commit_message: str = "docs: update repository documentation") -> str:
+    """
+    Commits many files to a branch as ONE atomic commit.
+    'files' is a list of {"path": ..., "content": ...}; paths get the same README
+    normalization as commit_file_to_github. Costs 5 requests regardless of file count.
+    """
+    if not files:
+        return "ERROR: No files provided."
     try:
-        response = requests.put(url, headers=headers, json=payload)
-        response.raise_for_status()
-        return f"SUCCESS: Committed to {target_path} on branch {branch}."
+        stale = _check_branch_not_stale(owner, repo, branch)
+        if stale:
+            return stale
+        result = _get_backend().commit_files(owner, repo, files, branch, commit_message)
+        _ref_pins.set(owner, repo, branch, result["commit_sha"])
+        _invalidate_repo_cache(owner, repo)
+        return json.dumps(dict(result, status="COMMITTED", branch=branch), indent=2)
+    except requests.exceptions.HTTPError as e:
+        return f"ERROR: Atomic commit failed: {e.response.text}"
     except Exception as e:
-        return f"ERROR: Commit failed for {target_path}: {response.text if 'response' in locals() else str(e)}"
+        return f"ERROR: Atomic commit failed: {e}"
 
 @mcp.tool()
 def create_pull_request(owner: str, repo: str, title: str, head_branch: str, base_branch: str = "main", body: str = "Pull Request created by an ADK agent.") -> str:
     """Creates a pull request from head_branch into base_branch."""
-    url = f"https://api.github.com/repos/{owner}/{repo}/pulls"
-    headers = _get_auth_headers()
-    payload = {"title": title, "head": head_branch, "base": base_branch, "body": body}
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-        pr_info = response.json()
+        pr_info = _get_backend().open_pull_request(owner, repo, title, head_branch, base_branch, body)
         return json.dumps({
             "status": "PR_CREATED", 
             "number": pr_info.get("number"), 
@@ -359,11 +3067,361 @@ def create_pull_request(owner: str, repo: str, title: str, head_branch: str, bas
         })
     except Exception as e: return f"ERROR: Failed to create PR: {e}"
 
+@mcp.tool()
+def publish_docs(owner: str, repo: str, base: str, files: list, title: str,
+                 body: str = "Pull Request created by an ADK agent.", branch: str = None,
+                 commit_message: str = "docs: update repository documentation") -> str:
+    """
+    Publishes generated docs in one call: creates a branch from 'base', commits
+    every {"path", "content"} in 'files' as ONE commit, and opens a PR into 'base'.
+    Paths get the same README normalization as commit_files_to_github.
+    If any step fails, the new branch is deleted again so nothing is left behind.
+    """
+    if not files:
+        return "ERROR: No files provided."
+    branch = branch or f"docs/update-{time.strftime('%Y%m%d-%H%M%S')}"
+    backend = _get_backend()
+    step = "check base"
+    created = False
+    try:
+        stale = _check_branch_not_stale(owner, repo, base)
+        if stale:
+            return stale
+        step = "create branch"
+        backend.create_branch(owner, repo, branch, base)
+        created = True
+        step = "commit"
+        commit = backend.commit_files(owner, repo, files, branch, commit_message)
+        step = "open pull request"
+        pr_info = backend.open_pull_request(owner, repo, title, branch, base, body)
+    except Exception as e:
+        detail = e.response.text if isinstance(e, requests.exceptions.HTTPError) else str(e)
+        rollback = "not needed"
+        if created:
+            try:
+                backend.delete_branch(owner, repo, branch)
+                rollback = f"deleted branch '{branch}'"
+            except Exception as rollback_error:
+                rollback = f"FAILED, delete branch '{branch}' manually: {rollback_error}"
+            _ref_pins.drop(owner, repo, branch)
+            _invalidate_repo_cache(owner, repo)
+        return f"ERROR: publish_docs failed at '{step}': {detail} (rollback: {rollback})"
+
+    _ref_pins.set(owner, repo, branch, commit["commit_sha"])
+    _invalidate_repo_cache(owner, repo)
+    return json.dumps({
+        "status": "PR_CREATED",
+        "branch": branch,
+        "commit_sha": commit["commit_sha"],
+        "paths": commit["paths"],
+        "number": pr_info.get("number"),
+        "html_url": pr_info.get("html_url"),
+        "message": f"Successfully created PR #{pr_info.get('number')}."
+    }, indent=2)
+
+@mcp.tool()
+def pin_ref(owner: str, repo: str, ref: str = None, refresh: bool = False) -> str:
+    """
+    Resolves a branch to the commit SHA this session reads from.
+    refresh=True re-resolves it; call it that way when a run picks its branch,
+    since pins last REF_PIN_TTL_SECONDS and may come from an earlier run.
+    """
+    try:
+        previous = _ref_pins.get(owner, repo, ref)
+        sha = _ref_pins.resolve(owner, repo, ref, refresh=refresh)
+        return json.dumps({"ref": ref or "default branch", "commit_sha": sha,
+                           "changed": previous is not None and previous != sha})
+    except Exception as e:
+        return f"ERROR: Failed to resolve ref: {e}"
+
+@mcp.tool()
+def load_repo_snapshot(owner: str, repo: str, ref: str = None) -> str:
+    """
+    Downloads one archive of 'ref' so listings, file reads, dependency lookups and
+    README scans for that branch are served locally with no further API calls.
+    """
+    if not isinstance(_get_backend(), _GitHubRestBackend):
+        return "INFO: Snapshots only apply to the GitHub backend; this server already reads from disk."
+    try:
+        snapshot = _snapshots.load(owner, repo, _pinned(owner, repo, ref))
+        if snapshot is None:
+            return (f"INFO: {owner}/{repo} is larger than SNAPSHOT_MAX_BYTES ({SNAPSHOT_MAX_BYTES} bytes); "
+                    f"reads keep using the REST API.")
+        return json.dumps({
+            "status": "SNAPSHOT_READY",
+            "commit_sha": snapshot.commit_sha,
+            "files": len(snapshot.files),
+            "bytes": snapshot.size
+        }, indent=2)
+    except Exception as e:
+        return f"ERROR: Failed to load snapshot: {e}"
+
+@mcp.tool()
+def get_cache_stats() -> str:
+    """Returns hit/miss counters for the response cache, request coalescing, snapshots and blob cache."""
+    return json.dumps({
+        "responses": _response_cache.snapshot(),
+        "shared_responses": _shared_responses.snapshot() if _shared_responses is not None
+                            else "disabled (set RESPONSE_CACHE_PATH)",
+        "coalescing": _inflight.snapshot(),
+        "symbol_index": _symbol_index.snapshot(),
+        "scan_jobs": _scan_jobs.snapshot(),
+        "snapshots": _snapshots.snapshot_stats(),
+        "blobs": _blob_cache.snapshot() if _blob_cache is not None else "disabled (set BLOB_CACHE_PATH)"
+    }, indent=2)
+
+@mcp.tool()
+def get_rate_limit_status(refresh: bool = False) -> str:
+    """
+    Returns the remaining GitHub rate-limit budget seen by the server.
+    refresh=True asks GitHub's /rate_limit endpoint first (it does not count against the limit).
+    """
+    if refresh:
+        try:
+            headers = _get_auth_headers()
+            response = _http_request("GET", f"{GITHUB_API_URL}/rate_limit", headers=headers)
+            response.raise_for_status()
+            _rate_limiter.record_rate_limit_payload(_token_key(headers), response.json())
+        except Exception as e:
+            return f"ERROR: Failed to refresh rate limit: {e}"
+    with _graphql_stats_lock:
+        graphql = dict(_graphql_stats)
+    return json.dumps(dict(_rate_limiter.snapshot(_partition()), graphql=graphql), indent=2)
+
+# --- OpenTelemetry tracing (optional) ---
+# Spans wrap every tool call and every GitHub request. A tool span's parent is
+# taken from a W3C traceparent in the call's _meta or the HTTP request headers,
+# so agent-side spans and server spans land in one trace. Tracing turns on when
+# OTEL_TRACES_FILE (one JSON span per line) or OTEL_EXPORTER_OTLP_ENDPOINT is set.
+OTEL_TRACES_FILE = os.getenv("OTEL_TRACES_FILE")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+
+trace = None
+if OTEL_TRACES_FILE or OTEL_EXPORTER_OTLP_ENDPOINT:  # the SDK is only imported when used
+    try:
+        from opentelemetry import trace, propagate
+        from opentelemetry.trace import Status, StatusCode
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        trace = None
+
+def _init_tracer():
+    if not (OTEL_TRACES_FILE or OTEL_EXPORTER_OTLP_ENDPOINT):
+        return None
+    if trace is None:
+        print("WARN: Tracing requested but opentelemetry-sdk is not installed", file=sys.stderr)
+        return None
+    provider = TracerProvider(resource=Resource.create(
+        {"service.name": os.getenv("OTEL_SERVICE_NAME", "github-mcp-server")}))
+    if OTEL_TRACES_FILE:
+        out = open(OTEL_TRACES_FILE, "a", encoding="utf-8")
+        exporter = ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+    if OTEL_EXPORTER_OTLP_ENDPOINT:
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        except ImportError:
+            print("WARN: OTEL_EXPORTER_OTLP_ENDPOINT set but the OTLP exporter is not installed", file=sys.stderr)
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer("mcp_server_v2")
+
+_tracer = _init_tracer()
+
+@contextlib.contextmanager
+def _span(name: str, attributes: dict = None, parent=None):
+    """Yields the active span, or None (at almost no cost) when tracing is off."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, context=parent, attributes=attributes) as span:
+        yield span
+
+def _incoming_trace_context(message):
+    """
+    Extracts the caller's trace context from HTTP headers and request _meta.
+    Returns None if a span is already active (newer FastMCP opens its own).
+    """
+    if trace.get_current_span().get_span_context().is_valid:
+        return None
+    carrier = {}
+    try:
+        from fastmcp.server.dependencies import get_http_headers
+        carrier.update(get_http_headers())
+    except Exception:
+        pass  # no HTTP request (e.g. in-memory client)
+    meta = getattr(message, "meta", None)
+    if meta is not None:
+        fields = meta if isinstance(meta, dict) else meta.model_dump()
+        carrier.update({k: v for k, v in fields.items() if isinstance(v, str)})
+    return propagate.extract(carrier) if "traceparent" in carrier else None
+
+# --- Prometheus metrics (served at /metrics next to the SSE endpoint) ---
+# Hot-path cost is a few counter increments per tool call / upstream request;
+# cache and rate-limit figures are read from the existing stats only at scrape time.
+_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_TOOL_CALLS = Counter("mcp_tool_calls_total", "MCP tool calls", ["tool", "outcome"])
+_TOOL_LATENCY = Histogram("mcp_tool_latency_seconds", "MCP tool call latency", ["tool"], buckets=_LATENCY_BUCKETS)
+_UPSTREAM_REQUESTS = Counter("github_requests_total", "Upstream GitHub API requests",
+                             ["endpoint", "method", "status"])
+_UPSTREAM_LATENCY = Histogram("github_request_latency_seconds", "Upstream GitHub API latency",
+                              ["endpoint"], buckets=_LATENCY_BUCKETS)
+_UPSTREAM_BYTES = Counter("github_response_bytes_total", "Bytes received from the GitHub API", ["endpoint"])
+
+def _endpoint_label(url: str) -> str:
+    """Collapses a GitHub URL to a low-cardinality label, e.g. 'repos/contents' or 'repos/git/trees'."""
+    path = url[len(GITHUB_API_URL):] if url.startswith(GITHUB_API_URL) else url
+    parts = [p for p in path.split("?", 1)[0].split("/") if p]
+    if parts[:1] == ["repos"] and len(parts) >= 3:
+        rest = parts[3:]
+        if not rest:
+            return "repos"
+        if rest[0] == "git" and len(rest) > 1:
+            return f"repos/git/{rest[1]}"
+        return f"repos/{rest[0]}"
+    return parts[0] if parts else "root"
+
+def _observe_upstream(method: str, url: str, response: requests.Response, streamed: bool = False):
+    endpoint = _endpoint_label(url)
+    _UPSTREAM_REQUESTS.labels(endpoint, method, str(response.status_code)).inc()
+    _UPSTREAM_LATENCY.labels(endpoint).observe(response.elapsed.total_seconds())
+    size = response.headers.get("Content-Length")
+    if size and size.isdigit():
+        _UPSTREAM_BYTES.labels(endpoint).inc(int(size))
+    elif not streamed:  # reading a streamed body here would load all of it
+        _UPSTREAM_BYTES.labels(endpoint).inc(len(response.content))
+
+class _ToolTelemetryMiddleware(Middleware):
+    """Counts, times and traces every tools/call. Tools report failures as 'ERROR:' strings."""
+
+    async def on_call_tool(self, context, call_next):
+        tool = context.message.name
+        parent = _incoming_trace_context(context.message) if _tracer is not None else None
+        start = time.perf_counter()
+        outcome = "exception"
+        with _span(f"mcp.tool {tool}", {"mcp.tool.name": tool}, parent=parent) as span:
+            try:
+                result = await call_next(context)
+                content = getattr(result, "content", None) or []
+                text = getattr(content[0], "text", "") if content else ""
+                outcome = "error" if text.startswith("ERROR") else "ok"
+                if span is not None and outcome == "error":
+                    span.set_status(Status(StatusCode.ERROR, text[:200]))
+                return result
+            finally:
+                _TOOL_CALLS.labels(tool, outcome).inc()
+                _TOOL_LATENCY.labels(tool).observe(time.perf_counter() - start)
+
+class _StatsCollector:
+    """Exposes cache and rate-limit stats as metrics when scraped."""
+
+    def collect(self):
+        caches = {"responses": _response_cache.snapshot()}
+        if _shared_responses is not None:
+            caches["shared_responses"] = _shared_responses.snapshot()
+        if _blob_cache is not None:
+            caches["blobs"] = _blob_cache.snapshot()
+        ratio = GaugeMetricFamily("mcp_cache_hit_ratio", "Cache hit ratio", labels=["cache"])
+        lookups = CounterMetricFamily("mcp_cache_lookups", "Cache lookups by result", labels=["cache", "result"])
+        for name, stats in caches.items():
+            ratio.add_metric([name], stats.get("hit_ratio", 0.0))
+            for result in ("hits", "revalidated", "misses"):
+                if result in stats:
+                    lookups.add_metric([name, result], stats[result])
+        snapshot_stats = _snapshots.snapshot_stats()
+        for result in ("hits", "builds"):
+            lookups.add_metric(["snapshots", result], snapshot_stats[result])
+        coalescing = _inflight.snapshot()
+        lookups.add_metric(["inflight", "coalesced"], coalescing["coalesced"])
+        lookups.add_metric(["inflight", "leaders"], coalescing["leaders"])
+        yield ratio
+        yield lookups
+
+        remaining = GaugeMetricFamily("github_rate_limit_remaining", "Remaining GitHub rate-limit budget",
+                                      labels=["token", "resource"])
+        limit = GaugeMetricFamily("github_rate_limit_limit", "GitHub rate-limit size", labels=["token", "resource"])
+        resets = GaugeMetricFamily("github_rate_limit_resets_in_seconds", "Seconds until the budget resets",
+                                   labels=["token", "resource"])
+        for token, resources in _rate_limiter.all_budgets().items():
+            for resource, budget in resources.items():
+                remaining.add_metric([token, resource], budget["remaining"])
+                limit.add_metric([token, resource], budget["limit"])
+                resets.add_metric([token, resource], budget["resets_in_seconds"])
+        yield remaining
+        yield limit
+        yield resets
+
+class _RequestTokenMiddleware(Middleware):
+    """Binds the caller's X-GitHub-Token header, if any, to this tool call."""
+
+    async def on_call_tool(self, context, call_next):
+        from fastmcp.server.dependencies import get_http_headers
+        token = get_http_headers(include={GITHUB_TOKEN_HEADER}).get(GITHUB_TOKEN_HEADER)
+        if not token:
+            return await call_next(context)
+        # Sync tools run in a worker thread that inherits this context
+        reset = _request_token.set(token.removeprefix("token ").removeprefix("Bearer ").strip())
+        try:
+            return await call_next(context)
+        finally:
+            _request_token.reset(reset)
+
+REGISTRY.register(_StatsCollector())
+mcp.add_middleware(_RequestTokenMiddleware())
+mcp.add_middleware(_ToolTelemetryMiddleware())
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics(request: Request) -> Response:
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Several uvicorn workers: aggregate counters from every process
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(_StatsCollector())
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+def _prepare_for_traffic():
+    """
+    Builds the connection pool and repository backend before the server starts
+    listening, so the first tool call does not pay for it. Makes no network calls.
+    """
+    _get_http_session()
+    _get_backend()
+
+_app = None
+
+def __getattr__(name):
+    """
+    'app' is the stateless streamable-HTTP ASGI app, built on first access, for
+    `uvicorn mcp_server_v2:app --workers N`. Each worker builds its own.
+    """
+    global _app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _app is None:
+        _prepare_for_traffic()
+        _app = mcp.http_app(path="/mcp", transport="http", stateless_http=True)
+    return _app
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8080))
     try:
-        print(f"Starting MCP SSE Server on port {port}...")
-        mcp.run(transport='sse', host='0.0.0.0', port=port)
+        if MCP_TRANSPORT in ("http", "streamable-http"):
+            print(f"Starting stateless MCP HTTP Server on port {port} with {WEB_CONCURRENCY} worker(s)...")
+            if WEB_CONCURRENCY > 1 and not RESPONSE_CACHE_PATH:
+                print("WARN: RESPONSE_CACHE_PATH is not set, so ref pins and caches are per worker.", file=sys.stderr)
+            # Hand over to the uvicorn CLI so each worker imports this module exactly once
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+            os.execvp(sys.executable, [sys.executable, "-m", "uvicorn", "mcp_server_v2:app", "--host", "0.0.0.0",
+                                       "--port", str(port), "--workers", str(WEB_CONCURRENCY)])
+        else:
+            _prepare_for_traffic()
+            print(f"Starting MCP SSE Server on port {port}...")
+            mcp.run(transport='sse', host='0.0.0.0', port=port)
     except Exception as e:
         print("--- UNCAUGHT MCP SERVER CRASH REPORT ---", file=sys.stderr)
         traceback.print_exc(file=sys.stderr)
@@ -6,6 +6,7 @@ import base64
 import sys 
 from fastmcp import FastMCP, Context
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 from github import Github, GithubException, Auth
 
@@ -13,6 +14,8 @@ from github import Github, GithubException, Auth
 mcp = FastMCP("githubexpertj6jan")
 
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+# Max parallel per-directory requests in find_readme_targets.
+SCAN_MAX_WORKERS = int(os.getenv("SCAN_MAX_WORKERS", 8))
 
 def _get_github_client():
     """Lazy initialization of the GitHub client."""
@@ -194,7 +197,7 @@ def analyze_and_suggest_readme(owner: str, repo: str, path: str = "", ref: str =
 #     existing_content = _read_read_file_logic(owner, repo, file_path, ref=ref)
 #     # ...@mcp.tool()
 
-def find_readme_targets(owner: str, repo: str, base_path: str = "", ref: str = None) -> str:
+def find_readme_targets(owner: str, repo: str, base_path: str = "", ref: str = None, max_workers: int = None) -> str:
     """Scans for subdirs missing READMEs. Use 'ref' for specific branches."""
     contents = _get_contents(owner, repo, base_path, ref=ref)
     
@@ -205,11 +208,14 @@ def find_readme_targets(owner: str, repo: str, base_path: str = "", ref: str = N
         targets = []
         subdirs_to_check_further = []
         subdirs = [item for item in contents if item.get("type") == "dir"]
+        subdir_paths = [os.path.join(base_path, subdir['name']).replace('\\', '/') for subdir in subdirs]
         
-        for subdir in subdirs:
-            subdir_path = os.path.join(base_path, subdir['name']).replace('\\', '/')
-            subdir_contents = _get_contents(owner, repo, subdir_path, ref=ref)
-            
+        # Fetch subdirectory listings in parallel; map() keeps the original order
+        workers = max(1, min(max_workers or SCAN_MAX_WORKERS, len(subdir_paths) or 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            listings = list(executor.map(lambda p: _get_contents(owner, repo, p, ref=ref), subdir_paths))
+        
+        for subdir_path, subdir_contents in zip(subdir_paths, listings):
             if isinstance(subdir_contents, str) and subdir_contents.startswith("ERROR"):
                 continue 
             
@@ -6,6 +6,7 @@ import base64
 import sys 
 from fastmcp import FastMCP, Context
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 from github import Github, GithubException, Auth
 
@@ -13,6 +14,8 @@ from github import Github, GithubException, Auth
 mcp = FastMCP("githubexpertj6jan")
 
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+# Max parallel per-directory requests in find_readme_targets.
+SCAN_MAX_WORKERS = int(os.getenv("SCAN_MAX_WORKERS", 8))
 
 def _get_github_client():
     """Lazy initialization of the GitHub client."""
@@ -206,11 +209,12 @@ def list_repo_directories(owner: str, repo: str, path: str = "", ref: str = None
         return f"ERROR: Failed to list directories: {e}"
 
 @mcp.tool()
-def find_readme_targets(owner: str, repo: str, base_path: str = "", include_paths: list = None, ref: str = None) -> str:
+def find_readme_targets(owner: str, repo: str, base_path: str = "", include_paths: list = None, ref: str = None, max_workers: int = None) -> str:
     """
     Scans for subdirectories missing READMEs. 
     If 'include_paths' is provided (list of folder names), only those folders are scanned.
     Otherwise, scans all subdirectories in 'base_path'.
+    Up to 'max_workers' directories are fetched in parallel.
     """
     # 1. Determine which directories to scan
     if include_paths:
@@ -225,16 +229,15 @@ def find_readme_targets(owner: str, repo: str, base_path: str = "", include_path
 
     try:
         targets = []
-        scanned_paths = []
+        # Construct the proper paths
+        scanned_paths = [os.path.join(base_path, subdir['name']).replace('\\', '/') for subdir in dirs_to_scan]
         
-        for subdir in dirs_to_scan:
-            # Construct the proper path
-            subdir_path = os.path.join(base_path, subdir['name']).replace('\\', '/')
-            scanned_paths.append(subdir_path)
-            
-            # Fetch contents of this specific subdirectory
-            subdir_contents = _get_contents(owner, repo, subdir_path, ref=ref)
-            
+        # Fetch subdirectory contents in parallel; map() keeps the original order
+        workers = max(1, min(max_workers or SCAN_MAX_WORKERS, len(scanned_paths) or 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            listings = list(executor.map(lambda p: _get_contents(owner, repo, p, ref=ref), scanned_paths))
+        
+        for subdir_path, subdir_contents in zip(scanned_paths, listings):
             if isinstance(subdir_contents, str) and subdir_contents.startswith("ERROR"):
                 continue 
             